@@ -0,0 +1,78 @@
+import collections
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Aho-Corasick matching of pitch class sequences. All the sequences are
+# compiled once into a 12 way state table, so a candidate is checked against
+# every one of them in a single pass over its pitch classes.
+
+class AhoCorasick(object):
+    def __init__(self, sequences):
+        goto = [dict()]
+        output = [False]
+        for sequence in sequences:
+            if [pc for pc in sequence if not 0 <= pc < 12]:
+                continue                # can never match a pitch class sequence
+            state = 0
+            for pc in sequence:
+                if pc not in goto[state]:
+                    goto[state][pc] = len(goto)
+                    goto.append(dict())
+                    output.append(False)
+                state = goto[state][pc]
+            output[state] = True
+
+        # breadth first, so each state's failure state is complete before it
+        # is needed, folding the failure links into a full transition table
+        delta = [ [0] * 12 for state in goto ]
+        fail = [0] * len(goto)
+        queue = collections.deque()
+        for pc, state in goto[0].items():
+            delta[0][pc] = state
+            queue.append(state)
+        while queue:
+            r = queue.popleft()
+            output[r] = output[r] or output[fail[r]]
+            for pc in xrange(12):
+                if pc in goto[r]:
+                    state = goto[r][pc]
+                    fail[state] = delta[fail[r]][pc]
+                    delta[r][pc] = state
+                    queue.append(state)
+                else:
+                    delta[r][pc] = delta[fail[r]][pc]
+        self.delta = delta
+        self.output = output
+        self.deltaTable = None
+
+    def __len__(self):
+        return len(self.delta)
+
+    def search(self, pcs):
+        ''' does any of the sequences occur in pcs '''
+        if self.output[0]:
+            return True                 # an empty sequence occurs everywhere
+        delta = self.delta
+        output = self.output
+        state = 0
+        for pc in pcs:
+            state = delta[state][pc]
+            if output[state]:
+                return True
+        return False
+
+    def searchBlock(self, pcs):
+        ''' search() for each row of a 2-D numpy array of pitch classes '''
+        if self.deltaTable is None:
+            self.deltaTable = numpy.array(self.delta, dtype=numpy.int32)
+            self.outputTable = numpy.array(self.output, dtype=bool)
+        nRows, n = pcs.shape
+        hit = numpy.empty(nRows, dtype=bool)
+        hit.fill(self.output[0])
+        state = numpy.zeros(nRows, dtype=numpy.int32)
+        for k in xrange(n):
+            state = self.deltaTable[state, pcs[:, k]]
+            hit |= self.outputTable[state]
+        return hit
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import sys, time, random
+import genmotifs
+from pcset import PcSet
+from acmatch import AhoCorasick
+
+# Microbenchmarks for the genmotifs candidate filters, run on random ngrams and
+# reported in microseconds per candidate.
+
+def perCandidate(fn, candidates, repeat=5):
+    best = None
+    for r in xrange(repeat):
+        start = time.time()
+        for candidate in candidates:
+            fn(candidate)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6 / len(candidates)
+
+def randomNgrams(scale, nNgrams, n, seed):
+    ''' mostly stepwise walks through the scale from its tonic, so that most of
+    them get through to the pitch collection tests '''
+    rand = random.Random(seed)
+    pitches = [ octave * 12 + pc for octave in xrange(-2, 3) for pc in scale.getPitches() ]
+    moves = [-3, -2, -1, -1, 0, 1, 1, 2, 3]
+    ngrams = []
+    for j in xrange(nNgrams):
+        index = pitches.index(0)
+        ngram = []
+        for i in xrange(n):
+            nextIndex = min(max(index + rand.choice(moves), 0), len(pitches) - 1)
+            ngram.append(pitches[nextIndex] - pitches[index])
+            index = nextIndex
+        ngrams.append(tuple(ngram))
+    return ngrams
+
+# The pitch collection tests as they were written with Python sets, kept as
+# the baseline for benchPcSet.
+
+def setWalk(scale, nGram, startPitch, minPcs):
+    # Scale.mapNgramToScale with no conjunct, unison or fix settings
+    nChromaticsSoFar = 0
+    pitch = startPitch
+    pitches = [startPitch,]
+    zeroSteps = 0
+    for step in nGram:
+        if step == 0:
+            zeroSteps += 1
+        pitch = (pitch + step)
+        if pitch % 12 not in scale.pcToStep:
+            nChromaticsSoFar += 1
+            if nChromaticsSoFar > 0:
+                return None
+        pitches.append(pitch)
+
+    pitchSet = set([x % 12 for x in pitches])
+    if len(pitchSet) < minPcs:
+        return None
+    return pitches
+
+def setFilters(scale, nGram, startPitch, minPcs, mustSet, poisonSets):
+    pitches = setWalk(scale, nGram, startPitch, minPcs)
+    if pitches:
+        pitchSequence = [x % 12 for x in pitches]
+        pitchSet = set(pitchSequence)
+        for poisonSet in poisonSets:
+            if poisonSet.issubset(pitchSet):
+                return False
+        return mustSet.issubset(pitchSet)
+    return False
+
+def maskFilters(scale, profile, startPitch, minPcs, mustSet, poisonSets):
+    # the profile is made once per ngram and shared by all the queries
+    walk = scale.mapProfileToScale(profile, startPitch, None, None, None, minPcs, None, None, 0)
+    if walk:
+        pitches, pitchSet = walk
+        return (genmotifs.avoidSets(pitchSet, poisonSets)
+                and genmotifs.havePitches(None, pitchSet, mustSet, 0, scale.pitchSet))
+    return False
+
+def benchPcSet(nNgrams, n):
+    scale = genmotifs.Diatonic()
+    ngrams = randomNgrams(scale, nNgrams, n, 1)
+    mustSet = scale.mustPitches
+    poisonSets = [PcSet([2, 5, 9, 11]), PcSet([0, 4, 7, 11]), PcSet([5, 7, 9, 11])]
+    sets = (set(mustSet), [set(poisonSet) for poisonSet in poisonSets])
+
+    profiles = [genmotifs.NgramProfile(ng) for ng in ngrams]
+
+    kept = [ ng for ng, profile in zip(ngrams, profiles) if maskFilters(scale, profile, 0, scale.minPcs, mustSet, poisonSets) ]
+    assert kept == [ ng for ng in ngrams if setFilters(scale, ng, 0, scale.minPcs, sets[0], sets[1]) ]
+
+    setTime = perCandidate(lambda ng: setFilters(scale, ng, 0, scale.minPcs, sets[0], sets[1]), ngrams)
+    maskTime = perCandidate(lambda profile: maskFilters(scale, profile, 0, scale.minPcs, mustSet, poisonSets), profiles)
+    profileTime = perCandidate(genmotifs.NgramProfile, ngrams)
+    print 'pcset: %d %d-grams, %d kept' % (nNgrams, n, len(kept))
+    print '    python sets   %.2f us/candidate' % (setTime,)
+    print '    PcSet masks   %.2f us/candidate  (%.2fx)' % (maskTime, setTime / maskTime)
+    print '    profile       %.2f us/ngram, once for all queries' % (profileTime,)
+
+def benchPoison(nNgrams, n):
+    scale = genmotifs.Diatonic()
+    candidates = [ [x % 12 for x in scale.mapNgramToScale(ng, 0, None, None, None, 0, None, None, 0)]
+                   for ng in randomNgrams(scale, nNgrams, n, 2) ]
+    rand = random.Random(3)
+    pcs = scale.getPitches()
+    print 'poison: %d %d-note candidates' % (nNgrams, n+1)
+    print '    %9s %12s %12s' % ('sequences', 'slices', 'automaton')
+    for nPoison in [1, 10, 100, 1000]:
+        # long enough that most candidates survive and get scanned to the end
+        poisonSequences = [ [rand.choice(pcs) for i in xrange(rand.randint(4, 6))] for j in xrange(nPoison) ]
+        matcher = AhoCorasick(poisonSequences)
+        someCandidates = candidates[:max(len(candidates) / nPoison, 200)]
+        assert ([ c for c in someCandidates if genmotifs.avoidSequences(c, poisonSequences) ]
+                == [ c for c in someCandidates if not matcher.search(c) ])
+        sliceTime = perCandidate(lambda c: genmotifs.avoidSequences(c, poisonSequences), someCandidates, 3)
+        matchTime = perCandidate(lambda c: matcher.search(c), candidates)
+        print '    %9d %9.2f us %9.2f us' % (nPoison, sliceTime, matchTime)
+
+if __name__ == '__main__':
+    options = ['help', 'ngrams=', 'n=']
+
+    def usage():
+        print 'benchmotifs.py [benchmark ...]'
+        print 'Benchmarks: pcset poison'
+        print 'Options:'
+        for word in options:
+            print '  ', word
+        sys.exit(0)
+
+    import getopt
+    def main():
+        nNgrams = 20000
+        n = 7
+        opts, pargs = getopt.getopt(sys.argv[1:], '', options)
+        for opt, val in opts:
+            if opt == '--help':
+                usage()
+            elif opt == '--ngrams':
+                nNgrams = int(val)
+            elif opt == '--n':
+                n = int(val)
+
+        benchmarks = pargs or ['pcset', 'poison']
+        for name in benchmarks:
+            if name == 'pcset':
+                benchPcSet(nNgrams, n)
+            elif name == 'poison':
+                benchPoison(nNgrams, n)
+            else:
+                raise Exception, 'no benchmark %s' % (name,)
+
+    main()
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
-import sys, os, os.path, random, time, codecs, pdb
-import midimaker, midi
+import sys, os, os.path, random, time, operator, struct, codecs, pdb, heapq, multiprocessing, getopt, json, collections, array, math, zlib
+import midimaker, midi, ngramstore, ngramtrie, motifcache, motifhistory
+from acmatch import AhoCorasick
+from pcset import PcSet, pcBits, pcCounts, pcMask, rotate
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from midimaker import Rest, ChordDelimiter
+from motifhistory import mask64, mix64, mix64Block
 
 Petrucci = '../Petrucci'
 
@@ -18,12 +25,12 @@ symbolToPitch = dict([(s,p) for p,s in enumerate(pitchToSymbol)])
 lf = u'\240a'
 
 def makeMustSet(symbols):
-    return set([symbolToPitch[symbol] for symbol in symbols])
+    return PcSet([symbolToPitch[symbol] for symbol in symbols])
 
 class Scale(object):
     def __init__(self):
         # maybe should change this to pitchToDegree for clarity
-        self.pitchSet = set(self.stepToPc.values())
+        self.pitchSet = PcSet(self.stepToPc.values())
         self.pcToStep = dict()
         self.pcToStepString = dict()
         self.stepToNote = dict()
@@ -31,14 +38,18 @@ class Scale(object):
         self.minNotes = 4
         self.maxNotes = 12
         self.mustFixPosition = None
-        self.mustPitches = set()
+        self.mustPitches = PcSet()
         self.minPcs = 0
         self.nChromatics = 0
         self.cue = [0, 7, 12]
         self.moniker = None
+        self.startTable = None
         for step, pc in self.stepToPc.items():
             self.pcToStep[pc] = step
             self.pcToStepString[pc] = '%d' % (step,)
+        if numpy is not None:
+            # in scale lookup by pitch class for mapNgramsToScale
+            self.inScaleTable = numpy.array([pc in self.pitchSet for pc in xrange(12)])
 
     def getPitches(self):
         pitches = self.pcToStep.keys()
@@ -48,54 +59,112 @@ class Scale(object):
     def mapNgramToScale(self, nGram, startPitch,
                          conjunct, outside, unisons, minPcs,
                         mustFixPosition, begOrEndSet, nChromatics):
-        nChromaticsSoFar = 0
+        walk = self.walkNgram(nGram, startPitch,
+                              conjunct, outside, unisons, minPcs,
+                              mustFixPosition, begOrEndSet, nChromatics)
+        if walk:
+            return walk[0]
+        return None
+
+    def walkNgram(self, nGram, startPitch,
+                  conjunct, outside, unisons, minPcs,
+                  mustFixPosition, begOrEndSet, nChromatics):
+        ''' mapNgramToScale that also returns the PcSet mask of the pitches it
+        collects on the way, as (pitches, mask) '''
+        return self.mapProfileToScale(NgramProfile(nGram), startPitch,
+                                      conjunct, outside, unisons, minPcs,
+                                      mustFixPosition, begOrEndSet, nChromatics)
+
+    def mapProfileToScale(self, profile, startPitch,
+                          conjunct, outside, unisons, minPcs,
+                          mustFixPosition, begOrEndSet, nChromatics):
+        ''' walkNgram for an ngram already profiled. Only the chromatic count and
+        the pitches themselves depend on the start pitch. '''
         assert (startPitch % 12) in self.pcToStep, 'illegal start pitch'
-        if (conjunct != None
-             and (max(abs(max(nGram)), abs(min(nGram)))) > conjunct):
-            return None
-        if outside == None:
-            outside = 100
-        pitch = startPitch
-        pitches = [startPitch,]
-        zeroSteps = 0
-        for step in nGram:
-            if step == 0:
-                zeroSteps += 1
-            pitch = (pitch + step)
-            if pitch % 12 not in self.pcToStep:
-                nChromaticsSoFar += 1
-                if nChromaticsSoFar > nChromatics:
-                    return None
-            pitches.append(pitch)
-            
-        if unisons != None and zeroSteps > unisons:
+        if conjunct != None and profile.maxLeap > conjunct:
             return None
-        if nChromaticsSoFar != nChromatics:
+        if unisons != None and profile.zeroSteps > unisons:
             return None
-
-        pitchSet = set([x % 12 for x in pitches])
-        if len(pitchSet) < minPcs:
+        if pcCounts[profile.mask] < minPcs:
             return None
-        if begOrEndSet and not (pitches[0] in begOrEndSet or pitches[-1] in begOrEndSet):
+        scaleSet = self.pitchSet
+        pitchSet = rotate(profile.mask, startPitch)
+        if nChromatics == 0:
+            if pitchSet & scaleSet != pitchSet:
+                return None
+        else:
+            nChromaticsSoFar = 0
+            for pc in profile.pcs:
+                if not pcBits[(pc + startPitch) % 12] & scaleSet:
+                    nChromaticsSoFar += 1
+            if nChromaticsSoFar != nChromatics:
+                return None
+        if begOrEndSet and not (startPitch in begOrEndSet
+                                or startPitch + profile.relative[-1] in begOrEndSet):
             return None
-        
+
         if mustFixPosition:
-            for sp in self.pcToStep.keys():
-                if sp == startPitch % 12:  # only check other start pitches
-                    continue
-                okay = False
-                pitch = sp
-                for step in nGram:
-                    pitch = (pitch + step)
-                    if pitch % 12 not in self.pcToStep:
-                        okay = True       # ngram out of scale from that start pitch
-                        break
-                if not okay:              # the ngram never stepped out of scale from new start pitch
-                    break
-                okay = True               # so far so good
-            if not okay:                  # were we good all the way?
-                return None
-        return pitches
+            # every start pitch from which the ngram stays in the scale
+            starts = self.getStartTable()[profile.mask]
+            if starts & ~pcBits[startPitch % 12]:
+                return None           # the ngram never stepped out of scale from another start pitch
+        return [startPitch + p for p in profile.relative], pitchSet
+
+    def getStartTable(self):
+        ''' For each mask of pitch classes relative to a start pitch, the mask of
+        start pitches from which all of them are in the scale. Built on first use. '''
+        if self.startTable is None:
+            scaleSet = self.pitchSet
+            table = [0] * (1 << 12)
+            for relative in xrange(1 << 12):
+                starts = 0
+                for sp in xrange(12):
+                    moved = rotate(relative, sp)
+                    if moved & scaleSet == moved:
+                        starts |= pcBits[sp]
+                table[relative] = starts
+            self.startTable = table
+            if numpy is not None:
+                self.startArray = numpy.array(table)
+        return self.startTable
+
+    def mapNgramsToScale(self, intervals, startPitch,
+                         conjunct, outside, unisons, minPcs,
+                         mustFixPosition, begOrEndSet, nChromatics):
+        ''' mapNgramToScale for a whole block of ngrams at once. intervals is a 2-D
+        numpy array, one ngram per row. Returns a keep mask and the pitch rows,
+        which are only meaningful where keep is True. '''
+        profile = BlockProfile(intervals)
+        keep = self.mapProfilesToScale(profile, startPitch,
+                                       conjunct, outside, unisons, minPcs,
+                                       mustFixPosition, begOrEndSet, nChromatics)
+        return keep, profile.relative + startPitch
+
+    def mapProfilesToScale(self, profile, startPitch,
+                           conjunct, outside, unisons, minPcs,
+                           mustFixPosition, begOrEndSet, nChromatics):
+        ''' mapProfileToScale for a BlockProfile, returning the keep mask '''
+        assert (startPitch % 12) in self.pcToStep, 'illegal start pitch'
+        keep = numpy.ones(len(profile), dtype=bool)
+        if conjunct != None:
+            keep &= profile.maxLeaps <= conjunct
+        if unisons != None:
+            keep &= profile.zeroSteps <= unisons
+        keep &= pcCountTable[profile.masks] >= minPcs
+        if nChromatics == 0:
+            keep &= (profile.masks & ~rotate(self.pitchSet, -startPitch)) == 0
+        else:
+            inScale = self.inScaleTable[(numpy.arange(12) + startPitch) % 12]
+            nOutside = profile.n - inScale[profile.pcs[:, 1:]].sum(axis=1)
+            keep &= nOutside == nChromatics
+        if begOrEndSet and startPitch not in begOrEndSet:
+            keep &= numpy.in1d(profile.relative[:, -1] + startPitch, list(begOrEndSet))
+
+        if mustFixPosition:
+            self.getStartTable()
+            starts = self.startArray[profile.masks]
+            keep &= (starts & ~pcBits[startPitch % 12]) == 0
+        return keep
 
     def stringifyMotif(self, motif):
         degrees = []
@@ -204,7 +273,7 @@ class AllMinor(Scale):
         self.stepToPc = dict([(1,0), (2,2), (3,3), (4,5), (5,7), (6,8), (7,9), (8,10), (9,11)])
         super(AllMinor, self).__init__()
         self.cue = [0, 3, 7, 12]        
-        self.mustPitches = set()
+        self.mustPitches = PcSet()
         self.moniker = 'mn'
 
 class Chromatic(Scale):
@@ -221,14 +290,14 @@ class Acoustic(Scale):
     def __init__(self):
         self.stepToPc = dict([(1,0), (2,2), (3,3), (4,5), (5,7), (6,9), (7,11)])
         super(Acoustic, self).__init__()
-        self.mustPitches = set()
+        self.mustPitches = PcSet()
         self.moniker = 'ac'
         
 class WholeTone(Scale):
     def __init__(self):
         self.stepToPc = dict([(1,0), (2,2), (3,4), (4,6), (5,8), (6,10)])
         super(WholeTone, self).__init__()
-        self.mustPitches = set()
+        self.mustPitches = PcSet()
         self.moniker = 'wt'
 
 class Octatonic(Scale):
@@ -270,18 +339,20 @@ class NgramAnalyzer(object):
 intervalName = dict([(i, ('U', 'm2', 'M2', 'm3', 'M3', 'P4', 'T', 'P5', 'm6', 'M6', 'm7', 'M7')[i]) for i in xrange(12)])
     
 def havePitches(pitchSequence, pitchSet, mustSet, nChromatics, scaleSet):
+    # all sets are PcSet masks
     if not mustSet:
         return True
     if nChromatics == 0:
-        return mustSet.issubset(pitchSet)
+        return mustSet & pitchSet == mustSet
     
     # mustSet must precede any chromatics
-    haveSet = set()
+    haveSet = 0
     for p in pitchSequence:
-        if p not in scaleSet:
+        bit = pcBits[p]
+        if not bit & scaleSet:
             return False
-        haveSet.add(p)
-        if mustSet.issubset(haveSet):
+        haveSet |= bit
+        if mustSet & haveSet == mustSet:
             return True
     raise Exception, 'Should have hit a chromatic note'
 
@@ -295,7 +366,7 @@ def avoidDouble(motif):
 
 def avoidSets(pitchSet, poisonSets):
     for poisonSet in poisonSets:
-        if poisonSet.issubset(pitchSet):
+        if poisonSet & pitchSet == poisonSet:
             return False
     return True
 
@@ -307,6 +378,99 @@ def avoidSequences(pitches, poisonSequences):
                 return False
     return True
 
+# Block versions of the filters above, used with mapNgramsToScale when numpy is
+# available. Rows are candidates, and each returns a keep mask over them.
+
+if numpy is not None:
+    pcCountTable = numpy.array(pcCounts)
+
+def pcMasks(pcs):
+    ''' 12 bit mask of the pitch classes in each row '''
+    return numpy.bitwise_or.reduce(numpy.left_shift(1, pcs), axis=1)
+
+def havePitchesBlock(pcs, masks, mustSet, nChromatics, inScaleTable):
+    nRows = len(pcs)
+    if not mustSet:
+        return numpy.ones(nRows, dtype=bool)
+    must = int(mustSet)
+    if nChromatics == 0:
+        return (masks & must) == must
+
+    # mustSet must precede any chromatics
+    firstChromatic = numpy.argmin(inScaleTable[pcs], axis=1)
+    haveSets = numpy.bitwise_or.accumulate(numpy.left_shift(1, pcs), axis=1)
+    have = haveSets[numpy.arange(nRows), firstChromatic - 1]
+    return (have & must) == must
+
+def avoidDoubleBlock(pitches):
+    nRows, n = pitches.shape
+    keep = numpy.ones(nRows, dtype=bool)
+    for i in xrange(n-3):
+        for j in xrange(i+2, n-1):
+            keep &= ~((pitches[:, i] == pitches[:, j]) & (pitches[:, i+1] == pitches[:, j+1]))
+    return keep
+
+def avoidSetsBlock(masks, poisonSets):
+    keep = numpy.ones(len(masks), dtype=bool)
+    for poisonSet in poisonSets:
+        poison = int(poisonSet)
+        keep &= (masks & poison) != poison
+    return keep
+
+# The shape of an ngram relative to its first note is the same for every scale
+# and start pitch, so it is worked out once per ngram read and shared by all
+# the queries offered it. Transposing the scale, must and poison sets down to
+# the start pitch instead of the ngram up to it leaves only the chromatic count
+# and the final pitches to work out per query.
+
+class NgramProfile(object):
+    __slots__ = ['relative', 'pcs', 'mask', 'zeroSteps', 'maxLeap', 'doubles']
+    def __init__(self, nGram):
+        pitch = 0
+        relative = [0,]
+        zeroSteps = 0
+        for step in nGram:
+            if step == 0:
+                zeroSteps += 1
+            pitch += step
+            relative.append(pitch)
+        self.relative = relative
+        self.pcs = [p % 12 for p in relative]
+        self.mask = pcMask(self.pcs)
+        self.zeroSteps = zeroSteps
+        self.maxLeap = max(abs(max(nGram)), abs(min(nGram)))
+        self.doubles = None
+
+    def noDoubles(self):
+        if self.doubles is None:
+            self.doubles = avoidDouble(self.relative)
+        return self.doubles
+
+class BlockProfile(object):
+    ''' NgramProfile for each row of a 2-D numpy array of intervals '''
+    def __init__(self, intervals):
+        nRows, n = intervals.shape
+        steps = intervals.astype(numpy.int32)
+        relative = numpy.empty((nRows, n+1), dtype=numpy.int32)
+        relative[:, 0] = 0
+        numpy.cumsum(steps, axis=1, out=relative[:, 1:])
+        self.n = n
+        self.relative = relative
+        self.pcs = relative % 12
+        self.masks = pcMasks(self.pcs)
+        self.zeroSteps = (steps == 0).sum(axis=1)
+        self.maxLeaps = numpy.abs(steps).max(axis=1)
+        self.doubles = None
+
+    def __len__(self):
+        return len(self.relative)
+
+    def noDoubles(self):
+        ''' avoidDouble for every row, only needed once some query gets that far '''
+        if self.doubles is None:
+            self.doubles = avoidDoubleBlock(self.relative)
+        return self.doubles
+
 class Tone(object):
     def __init__(self, symbol, scales):
         self.symbol = symbol
@@ -325,53 +489,986 @@ def encodeMelody(mel):
             uChars.append(midi.getUnicodeDegreeName(pc))
     return u''.join(uChars)
 
+def decodeMelody(emelody):
+    ''' the pitch classes and rests of an encodeMelody string '''
+    mel = []
+    i = 0
+    while i < len(emelody):
+        if emelody[i] == u' ':
+            mel.append(Rest)
+            i += 1
+            continue
+        n = emelody[i] in u'\u266d\u266f' and 2 or 1
+        mel.append(midi.unicodeDegreeNames.index(emelody[i:i+n]))
+        i += n
+    return mel
+
+def logIdentities(logName):
+    ''' the motifhistory identities of the motifs in a .log file genmotifs
+    wrote, leaving out the Dyad ones '''
+    lfp = codecs.open(logName, 'r', 'utf_16')
+    try:
+        for line in lfp:
+            at = line.find(u' Melody: ')
+            if at < 0:
+                continue
+            words = line[at + len(u' Melody: '):].rstrip(u'\r\n').split(u' ')
+            # the scale's class name follows the melody, and then any footnote
+            for w in xrange(len(words) - 1, 0, -1):
+                scaleClass = globals().get(str(words[w]))
+                if isinstance(scaleClass, type) and issubclass(scaleClass, Scale):
+                    break
+            else:
+                continue
+            motifString = scaleClass().stringifyMotif(decodeMelody(u' '.join(words[:w])))
+            yield '%s %s' % (scaleClass.__name__, motifString)
+    finally:
+        lfp.close()
+
+def ngramFileName(i):
+    return os.path.abspath(Petrucci + "/ngram%d.csv" % (i,))
+
+# ngram arrays held in memory by a long running process such as motifserver.py,
+# read in place of the files
+residentNgrams = {}
+
+def loadResidentNgrams(sizes):
+    ''' read the ngram files of these sizes once, for every later scan to use '''
+    global residentNgrams
+    resident = {}
+    for i in sizes:
+        if haveNgrams(i):
+            resident[i] = loadNgrams(i)
+    residentNgrams = resident
+
+def blockSlices(intervals, counts):
+    ''' yield consecutive blocks of rows of the arrays as readNgramBlocks does '''
+    blockRows = firstBlockRows
+    start = 0
+    while start < len(counts):
+        yield intervals[start:start+blockRows], counts[start:start+blockRows]
+        start += blockRows
+        blockRows = min(2 * blockRows, maxBlockRows)
+
+# a directory, such as /dev/shm/genmotifs, of binary stores parsed from .csv
+# files and shared by the processes mapping them
+sharedNgrams = None
+
+def localStoreName(i):
+    ''' the binary or block store beside ngram file i, or None '''
+    for name in [ngramstore.storeName(Petrucci, i), ngramstore.blockStoreName(Petrucci, i)]:
+        if os.path.exists(name):
+            return name
+    return None
+
+def ngramStoreName(i):
+    ''' the binary or block store to read ngram file i from, or None to read
+    the .csv '''
+    name = localStoreName(i)
+    if name:
+        return name
+    if sharedNgrams and os.path.exists(ngramFileName(i)):
+        return ngramstore.sharedStore(sharedNgrams, ngramFileName(i), i, lambda: readNgramFile(i))
+    return None
+
+def readNgramFile(i):
+    ''' yield (count, ngram) rows of the .csv file, as ngramstore writes them '''
+    f = open(ngramFileName(i))
+    try:
+        for line in f:
+            ng, count = parseNgramLine(line)
+            yield count, ng
+    finally:
+        f.close()
+
+def parseNgramLine(line):
+    ng, year, count = line.rstrip().split('\t')
+    return tuple(map(int, ng.split())), int(count)
+
+def haveNgrams(i):
+    return (i in residentNgrams
+            or os.path.exists(ngramstore.storeName(Petrucci, i))
+            or os.path.exists(ngramstore.blockStoreName(Petrucci, i))
+            or os.path.exists(ngramFileName(i)))
+
+def ngramSpans(i, nSpans):
+    ''' split an ngram file into at most nSpans consecutive (start, stop) spans
+    for readNgrams and readNgramBlocks: rows of the resident arrays or binary
+    store, or byte offsets of line starts in the .csv file '''
+    if i in residentNgrams:
+        size = len(residentNgrams[i][1])
+    else:
+        name = ngramStoreName(i)
+        if name:
+            store = ngramstore.openStore(name)
+            size = len(store)
+            store.close()
+        else:
+            size = None
+    if size is not None:
+        bounds = [ size * k // nSpans for k in xrange(nSpans + 1) ]
+    else:
+        name = ngramFileName(i)
+        size = os.path.getsize(name)
+        bounds = [0]
+        f = open(name, 'rb')
+        try:
+            for k in xrange(1, nSpans):
+                # the start of the first line beginning at or after the even split
+                f.seek(max(size * k // nSpans - 1, bounds[-1]))
+                f.readline()
+                bounds.append(min(f.tell(), size))
+        finally:
+            f.close()
+        bounds.append(size)
+    return [ (start, stop) for start, stop in zip(bounds, bounds[1:]) if start < stop ]
+
+def readNgrams(i, span=None, skip=None):
+    ''' yield (ngram, count) pairs from a reformatted ngram file, most popular first,
+    or only those of one of its ngramSpans. Uses the binary or block store when
+    reformatPetrucci.py has written one, passing over the blocks that skip, as
+    BlockStore takes it, has no use for. '''
+    if i in residentNgrams:
+        intervals, counts = residentNgrams[i]
+        if span:
+            intervals = intervals[span[0]:span[1]]
+            counts = counts[span[0]:span[1]]
+        for intervals, counts in blockSlices(intervals, counts):
+            for ng, count in zip(intervals.tolist(), counts.tolist()):
+                yield tuple(ng), count
+        return
+    name = ngramStoreName(i)
+    if name:
+        store = ngramstore.openStore(name)
+        try:
+            start, stop = span or (0, len(store))
+            for row in store.iterRows(start, stop, skip):
+                yield row
+        finally:
+            store.close()
+        return
+    f = open(ngramFileName(i))
+    try:
+        if span:
+            f.seek(span[0])
+            lines = readLines(f, span[1] - span[0])
+        else:
+            lines = f
+        for line in lines:
+            yield parseNgramLine(line)
+    finally:
+        f.close()
+
+def readLines(f, nBytes):
+    ''' yield the lines in the next nBytes of f '''
+    while nBytes > 0:
+        line = f.readline()
+        if not line:
+            break
+        nBytes -= len(line)
+        yield line
+
+# numpy scans go a block of ngrams at a time, starting small since a query
+# with a low top often fills from the first few hundred rows
+useBlocks = numpy is not None
+useTrie = False
+firstBlockRows = 256
+maxBlockRows = 65536
+
+def readNgramBlocks(i, span=None, skip=None):
+    ''' yield (intervals, counts) numpy arrays of consecutive ngram rows, of the
+    whole file or one of its ngramSpans, less any blocks skipped as for readNgrams '''
+    if i in residentNgrams:
+        intervals, counts = residentNgrams[i]
+        if span:
+            intervals = intervals[span[0]:span[1]]
+            counts = counts[span[0]:span[1]]
+        for block in blockSlices(intervals, counts):
+            yield block
+        return
+    name = ngramStoreName(i)
+    if name:
+        store = ngramstore.openStore(name)
+        try:
+            start, stop = span or (0, None)
+            for block in store.blocks(firstBlockRows, maxBlockRows, start, stop, skip):
+                yield block
+        finally:
+            store.close()
+        return
+    blockRows = firstBlockRows
+    ngs = []
+    counts = []
+    for ng, count in readNgrams(i, span):
+        ngs.append(ng)
+        counts.append(count)
+        if len(ngs) == blockRows:
+            yield numpy.array(ngs, dtype=numpy.int32), numpy.array(counts)
+            ngs = []
+            counts = []
+            blockRows = min(2 * blockRows, maxBlockRows)
+    if ngs:
+        yield numpy.array(ngs, dtype=numpy.int32), numpy.array(counts)
+
+def loadNgrams(i):
+    ''' (intervals, counts) numpy arrays of a whole ngram file '''
+    if i in residentNgrams:
+        return residentNgrams[i]
+    name = ngramStoreName(i)
+    if name:
+        store = ngramstore.openStore(name)
+        if len(store):
+            return store.arrays()     # the views keep the mapping open
+    blocks = list(readNgramBlocks(i))
+    if not blocks:
+        return numpy.zeros((0, i), dtype=numpy.int8), numpy.zeros(0, dtype=numpy.int64)
+    return (numpy.concatenate([intervals for intervals, counts in blocks]),
+            numpy.concatenate([counts for intervals, counts in blocks]))
+
+# Motifs are kept as Motif records: the pitches as a short int array, with the
+# rest and chord marks coded above any pitch, and the scale as a small id. Their
+# order, by count and then pitches, is that of a string key worked out once: the
+# count and then each code offset to be unsigned, all big endian, so that the
+# string compares as (count, pitches) tuples did, rests and chord marks after
+# pitches and a shorter motif before any it begins.
+
+restCode = 32767
+chordCode = 32766
+tokenCodes = {Rest: restCode, ChordDelimiter: chordCode}
+codeTokens = {restCode: Rest, chordCode: ChordDelimiter}
+countKey = struct.Struct('>Q')
+
+scaleIds = {}
+scalesById = []
+
+def motifKey(count, codes):
+    order = array.array('H', [code + 32768 for code in codes])
+    if sys.byteorder == 'little':
+        order.byteswap()
+    return countKey.pack(count) + order.tostring()
+
+def getScaleId(scale):
+    ''' a small id shared by all the instances of a scale class '''
+    scaleClass = scale.__class__
+    if scaleClass not in scaleIds:
+        scaleIds[scaleClass] = len(scalesById)
+        scalesById.append(scale)
+    return scaleIds[scaleClass]
+
+class Motif(object):
+    __slots__ = ['key', 'count', 'codes', 'scaleId', 'fileBase', 'footnote', 'name']
+    def __init__(self, count, pitches, scaleId, fileBase, footnote=None):
+        self.count = count
+        self.codes = array.array('h', [tokenCodes.get(p, p) for p in pitches])
+        self.key = motifKey(count, self.codes)
+        self.scaleId = scaleId
+        self.fileBase = fileBase
+        self.footnote = footnote
+        self.name = None
+
+    def getPitches(self):
+        return [codeTokens.get(code, code) for code in self.codes]
+    pitches = property(getPitches)
+
+    def getScale(self):
+        return scalesById[self.scaleId]
+    scale = property(getScale)
+
+    def __repr__(self):
+        return repr((self.count, self.pitches, self.scale, self.name, self.fileBase, self.footnote))
+
+class MotifSearch(object):
+    ''' The queries for one scale, whose motifs compete for a single top list.
+    The list is a heap of the nTop best so far, worst at the root, as (key,
+    motif) pairs so that the heap compares keys alone. '''
+    # the seed of a SampleSearch
+    seed = None
+
+    def __init__(self, nTop, queries):
+        self.nTop = nTop
+        self.queries = []
+        self.heap = []
+        for query in queries:
+            self.addQuery(query)
+
+    def addQuery(self, query):
+        self.queries.append(query)
+        query.search = self
+
+    def offer(self, motif):
+        self.push(motif.key, motif)
+
+    def push(self, key, motif):
+        if len(self.heap) < self.nTop:
+            heapq.heappush(self.heap, (key, motif))
+        elif self.nTop > 0 and key > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (key, motif))
+
+    def couldUse(self, count):
+        ''' can a motif with this count still make the top list '''
+        if len(self.heap) < self.nTop:
+            return True
+        return self.nTop > 0 and count >= self.heap[0][1].count
+
+    def getTops(self):
+        return sorted([motif for key, motif in self.heap], key=operator.attrgetter('key'), reverse=True)
+
+    def offerBlock(self, query, counts, pitchRows):
+        ''' offer the motifs of the rows a query kept from a block, returning
+        how many there were '''
+        counts = counts.tolist()
+        pitchRows = pitchRows.tolist()
+        for count, pitches in zip(counts, pitchRows):
+            if query.cue:
+                pitches = query.cue + [Rest,] + pitches
+            self.offer(Motif(count, pitches, query.scaleId, query.fileBase))
+        return len(counts)
+
+# Sampling draws the motifs of a scale at random in proportion to their counts,
+# without replacement, as a weighted reservoir: each candidate gets the key
+# log(u) / count and the nTop largest keys are kept. u comes from a hash of the
+# seed, the scale and the motif's pitches rather than from a random stream, so
+# the same seed draws the same motifs however the files are scanned.
+
+class SampleSearch(MotifSearch):
+    ''' MotifSearch keeping a count weighted sample of nTop motifs instead of
+    the nTop most popular. Its queries take every motif from every file. Its
+    heap is keyed by sampleKey, and getTops lists the sample most popular first
+    by each motif's own key, as a top list would be. '''
+    def __init__(self, nTop, queries, seed, scaleClassname):
+        self.seed = seed
+        self.hashSeed = mix64(((seed << 32) ^ (zlib.crc32(scaleClassname) & 0xffffffff)) & mask64)
+        MotifSearch.__init__(self, nTop, queries)
+
+    def addQuery(self, query):
+        MotifSearch.addQuery(self, query)
+        query.fill = sys.maxint
+
+    def couldUse(self, count):
+        return True
+
+    def sampleKey(self, count, codes):
+        h = mix64(self.hashSeed ^ len(codes))
+        for code in codes:
+            h = mix64(h ^ (code & 0xffffffff))
+        if count == 0:
+            return float('-inf')
+        return math.log(((h >> 12) + 0.5) * 2.0 ** -52) / count
+
+    def offer(self, motif):
+        self.push(self.sampleKey(motif.count, motif.codes), motif)
+
+    def offerBlock(self, query, counts, pitchRows):
+        ''' sampleKey for each row at once, making motifs of only the rows
+        whose keys beat the smallest key kept so far '''
+        nCodes = pitchRows.shape[1]
+        if query.cue:
+            cueCodes = [ tokenCodes.get(p, p) for p in query.cue + [Rest,] ]
+        else:
+            cueCodes = []
+        prefix = mix64(self.hashSeed ^ (len(cueCodes) + nCodes))
+        for code in cueCodes:
+            prefix = mix64(prefix ^ (code & 0xffffffff))
+        h = numpy.empty(len(counts), dtype=numpy.uint64)
+        h.fill(prefix)
+        codes = (pitchRows.astype(numpy.int64) & 0xffffffff).astype(numpy.uint64)
+        for column in xrange(nCodes):
+            h = mix64Block(h ^ codes[:, column])
+        u = ((h >> numpy.uint64(12)).astype(numpy.float64) + 0.5) * 2.0 ** -52
+        olderr = numpy.seterr(divide='ignore')
+        try:
+            keys = numpy.log(u) / counts
+        finally:
+            numpy.seterr(**olderr)
+        rows = numpy.arange(len(counts))
+        if len(self.heap) >= self.nTop:
+            if self.nTop == 0:
+                return len(counts)
+            rows = numpy.flatnonzero(keys > self.heap[0][0])
+        for row in rows.tolist():
+            pitches = pitchRows[row].tolist()
+            if query.cue:
+                pitches = query.cue + [Rest,] + pitches
+            motif = Motif(int(counts[row]), pitches, query.scaleId, query.fileBase)
+            self.push(float(keys[row]), motif)
+        return len(counts)
+
+def makeSearch(scaleClassname, nTop, seed):
+    ''' an empty MotifSearch for a scale, or SampleSearch if there is a seed '''
+    if seed is None:
+        return MotifSearch(nTop, [])
+    return SampleSearch(nTop, [], seed, scaleClassname)
+
+class MotifQuery(object):
+    ''' One (scale, start pitch, filter set) combination searched by scanNgrams.
+    Offers its motifs to its MotifSearch, taking at most nTop from each ngram file. '''
+    # NgramFileScan may pass over blocks whose ngrams this query would turn away
+    skipsBlocks = True
+
+    def __init__(self, scale, nTop, minGrams, maxGrams, cue, startPitch,
+                 conjunct, outside, unisons, minPcs, mustFix, mustSet,
+                 nChromatics, begOrEndSet, poisonSets, poisonSequences, fileBase,
+                 released=None):
+        self.scale = scale
+        self.nTop = nTop
+        self.minGrams = minGrams
+        self.maxGrams = maxGrams
+        self.cue = cue
+        self.startPitch = startPitch
+        self.conjunct = conjunct
+        self.outside = outside
+        self.unisons = unisons
+        self.minPcs = minPcs
+        self.mustFix = mustFix
+        self.mustSet = mustSet
+        self.nChromatics = nChromatics
+        self.begOrEndSet = begOrEndSet
+        self.poisonSets = poisonSets
+        self.poisonSequences = poisonSequences
+        self.fileBase = fileBase
+        # the most motifs taken from one ngram file, at least one as a query
+        # wanting no motifs at all always took one
+        self.fill = max(nTop, 1)
+        self.search = None
+        self.scaleId = getScaleId(scale)
+        # the filters run on ngram profiles, relative to the start pitch
+        self.relativeScale = rotate(scale.pitchSet, -startPitch)
+        self.relativeMust = rotate(mustSet, -startPitch)
+        self.relativePoisonSets = [rotate(poisonSet, -startPitch) for poisonSet in poisonSets]
+        # all the poison sequences are checked in one pass
+        self.poisonMatcher = AhoCorasick([ [(pc - startPitch) % 12 for pc in sequence]
+                                           for sequence in poisonSequences
+                                           if not [pc for pc in sequence if not 0 <= pc < 12] ])
+        self.relativeInScaleTable = None
+        # the motifhistory.ReleaseHistory of motifs to leave out, and what
+        # comes before the pitches in their identities
+        self.released = None
+        if released:
+            self.released = motifhistory.openHistory(released)
+            self.releasedPrefix = scale.__class__.__name__ + ' '
+            if cue:
+                self.releasedPrefix += scale.stringifyMotif(cue + [Rest,])
+            self.releasedChars = None
+
+    def wants(self, i):
+        return self.minGrams <= i <= self.maxGrams
+
+    def isReleased(self, pitches):
+        ''' whether the motif of these pitches, after any cue, was released '''
+        return self.releasedPrefix + self.scale.stringifyMotif(pitches) in self.released
+
+    def releasedBlock(self, pitchRows):
+        ''' isReleased() for each row of pitches '''
+        if self.releasedChars is None:
+            self.releasedChars = numpy.array([ ord(self.scale.pcToStepString.get(pc, 'x'))
+                                               for pc in xrange(12) ], dtype=numpy.uint8)
+        return self.released.containsBlock(self.releasedPrefix, self.releasedChars[pitchRows % 12])
+
+    def consider(self, profile, count):
+        ''' returns True if the ngram made a motif '''
+        scale = self.scale
+        walk = scale.mapProfileToScale(profile, self.startPitch,
+                                       self.conjunct, self.outside, self.unisons, self.minPcs,
+                                       self.mustFix, self.begOrEndSet, self.nChromatics)
+        if walk:
+            pitches, pitchSet = walk
+            if (avoidSets(profile.mask, self.relativePoisonSets)
+                and havePitches(profile.pcs, profile.mask, self.relativeMust, self.nChromatics, self.relativeScale)
+                and profile.noDoubles()
+                and not (self.poisonSequences and self.poisonMatcher.search(profile.pcs))
+                and not (self.released and self.isReleased(pitches))):
+
+                if self.cue:
+                    pitches = self.cue + [Rest,] + pitches
+                self.search.offer(Motif(count, pitches, self.scaleId, self.fileBase))
+                return True
+        return False
+
+    def filterBlock(self, profile):
+        ''' consider() for a BlockProfile. Returns the keep mask over the block
+        and the pitch rows of the ngrams kept. '''
+        keep = self.scale.mapProfilesToScale(profile, self.startPitch,
+                                             self.conjunct, self.outside, self.unisons, self.minPcs,
+                                             self.mustFix, self.begOrEndSet, self.nChromatics)
+        rows = numpy.flatnonzero(keep)
+        pcs = profile.pcs[rows]
+        masks = profile.masks[rows]
+        if self.relativeInScaleTable is None:
+            self.relativeInScaleTable = self.scale.inScaleTable[(numpy.arange(12) + self.startPitch) % 12]
+        passed = (avoidSetsBlock(masks, self.relativePoisonSets)
+                  & havePitchesBlock(pcs, masks, self.relativeMust, self.nChromatics, self.relativeInScaleTable)
+                  & ~self.poisonMatcher.searchBlock(pcs))
+        if len(rows):
+            passed &= profile.noDoubles()[rows]
+        keep[rows[~passed]] = False
+        pitchRows = profile.relative[rows[passed]] + self.startPitch
+        if self.released and len(pitchRows):
+            held = self.releasedBlock(pitchRows)
+            keep[rows[passed][held]] = False
+            pitchRows = pitchRows[~held]
+        return keep, pitchRows
+
+    def considerBlock(self, profile, counts, nWanted):
+        ''' consider() the rows of a block in order until nWanted have made
+        motifs, returning how many did '''
+        keep, pitchRows = self.filterBlock(profile)
+        return self.search.offerBlock(self, counts[keep][:nWanted], pitchRows[:nWanted])
+
+class FunnelQuery(MotifQuery):
+    ''' MotifQuery that also counts, for each ngram size, the ngrams it reads,
+    how many each filter turns away and the time each filter takes. The filters
+    run one at a time on what the earlier ones let through, so each rejection
+    is put down to the first filter that made it. Only used with --funnel, so
+    plain queries pay nothing for it. With --trie the counts start after the
+    trie has passed over what broke the chromatic, conjunct or unison limit. '''
+    checks = ['conjunct', 'unisons', 'minPcs', 'chromatics', 'begOrEnd', 'fix',
+              'poisonSets', 'must', 'doubles', 'poisonSequences', 'released']
+    # every ngram is counted, even in a block store block no query could use
+    skipsBlocks = False
+
+    def __init__(self, *args, **kwargs):
+        MotifQuery.__init__(self, *args, **kwargs)
+        self.funnel = {}
+
+    def funnelFor(self, n):
+        if n not in self.funnel:
+            self.funnel[n] = dict(read=0, passed=0, offered=0,
+                                  rejected=dict([(check, 0) for check in self.checks]),
+                                  seconds=dict([(check, 0.0) for check in self.checks]))
+        return self.funnel[n]
+
+    def records(self):
+        ''' a JSON ready dict for each ngram size read '''
+        return [ dict(scale=self.scale.__class__.__name__, start=self.startPitch, n=n, **self.funnel[n])
+                 for n in sorted(self.funnel) ]
+
+    def passes(self, check, profile):
+        ''' one of the checks of mapProfileToScale and consider '''
+        startPitch = self.startPitch
+        if check == 'conjunct':
+            return self.conjunct == None or profile.maxLeap <= self.conjunct
+        elif check == 'unisons':
+            return self.unisons == None or profile.zeroSteps <= self.unisons
+        elif check == 'minPcs':
+            return pcCounts[profile.mask] >= self.minPcs
+        elif check == 'chromatics':
+            nOutside = len([pc for pc in profile.pcs if not pcBits[pc] & self.relativeScale])
+            return nOutside == self.nChromatics
+        elif check == 'begOrEnd':
+            return (not self.begOrEndSet or startPitch in self.begOrEndSet
+                    or startPitch + profile.relative[-1] in self.begOrEndSet)
+        elif check == 'fix':
+            return (not self.mustFix
+                    or not self.scale.getStartTable()[profile.mask] & ~pcBits[startPitch % 12])
+        elif check == 'poisonSets':
+            return avoidSets(profile.mask, self.relativePoisonSets)
+        elif check == 'must':
+            return havePitches(profile.pcs, profile.mask, self.relativeMust, self.nChromatics, self.relativeScale)
+        elif check == 'doubles':
+            return profile.noDoubles()
+        elif check == 'poisonSequences':
+            return not (self.poisonSequences and self.poisonMatcher.search(profile.pcs))
+        elif check == 'released':
+            return not (self.released and self.isReleased([startPitch + p for p in profile.relative]))
+
+    def passesBlock(self, check, profile):
+        ''' passes() for every row of a BlockProfile '''
+        startPitch = self.startPitch
+        nRows = len(profile)
+        if check == 'conjunct':
+            if self.conjunct == None:
+                return numpy.ones(nRows, dtype=bool)
+            return profile.maxLeaps <= self.conjunct
+        elif check == 'unisons':
+            if self.unisons == None:
+                return numpy.ones(nRows, dtype=bool)
+            return profile.zeroSteps <= self.unisons
+        elif check == 'minPcs':
+            return pcCountTable[profile.masks] >= self.minPcs
+        elif check == 'chromatics':
+            nOutside = profile.n + 1 - self.relativeInScaleTable[profile.pcs].sum(axis=1)
+            return nOutside == self.nChromatics
+        elif check == 'begOrEnd':
+            if not self.begOrEndSet or startPitch in self.begOrEndSet:
+                return numpy.ones(nRows, dtype=bool)
+            return numpy.in1d(profile.relative[:, -1] + startPitch, list(self.begOrEndSet))
+        elif check == 'fix':
+            if not self.mustFix:
+                return numpy.ones(nRows, dtype=bool)
+            self.scale.getStartTable()
+            return (self.scale.startArray[profile.masks] & ~pcBits[startPitch % 12]) == 0
+        elif check == 'poisonSets':
+            return avoidSetsBlock(profile.masks, self.relativePoisonSets)
+        elif check == 'must':
+            return havePitchesBlock(profile.pcs, profile.masks, self.relativeMust, self.nChromatics,
+                                    self.relativeInScaleTable)
+        elif check == 'doubles':
+            return profile.noDoubles()
+        elif check == 'poisonSequences':
+            return ~self.poisonMatcher.searchBlock(profile.pcs)
+        elif check == 'released':
+            if not self.released:
+                return numpy.ones(nRows, dtype=bool)
+            return ~self.releasedBlock(profile.relative + startPitch)
+
+    def consider(self, profile, count):
+        funnel = self.funnelFor(len(profile.relative) - 1)
+        funnel['read'] += 1
+        for check in self.checks:
+            start = time.time()
+            passed = self.passes(check, profile)
+            funnel['seconds'][check] += time.time() - start
+            if not passed:
+                funnel['rejected'][check] += 1
+                return False
+        funnel['passed'] += 1
+        funnel['offered'] += 1
+        pitches = [self.startPitch + p for p in profile.relative]
+        if self.cue:
+            pitches = self.cue + [Rest,] + pitches
+        self.search.offer(Motif(count, pitches, self.scaleId, self.fileBase))
+        return True
+
+    def firstFailed(self, profile):
+        ''' for each row of a BlockProfile, the index of the first check it
+        fails, or len(checks) if it passes them all '''
+        funnel = self.funnelFor(profile.n)
+        if self.relativeInScaleTable is None:
+            self.relativeInScaleTable = self.scale.inScaleTable[(numpy.arange(12) + self.startPitch) % 12]
+        nChecks = len(self.checks)
+        first = numpy.empty(len(profile), dtype=int)
+        first.fill(nChecks)
+        for k, check in enumerate(self.checks):
+            start = time.time()
+            passed = self.passesBlock(check, profile)
+            funnel['seconds'][check] += time.time() - start
+            first[(first == nChecks) & ~passed] = k
+        return first
+
+    def filterBlock(self, profile):
+        keep = self.firstFailed(profile) == len(self.checks)
+        return keep, profile.relative[keep] + self.startPitch
+
+    def considerBlock(self, profile, counts, nWanted):
+        ''' counts only the rows a row by row scan would have read: up to the
+        nWanted-th motif, or up to the first whose count cannot make the top
+        list '''
+        funnel = self.funnelFor(profile.n)
+        first = self.firstFailed(profile).tolist()
+        offered = 0
+        for row, count in enumerate(counts.tolist()):
+            if offered >= nWanted or not self.search.couldUse(count):
+                break
+            funnel['read'] += 1
+            if first[row] < len(self.checks):
+                funnel['rejected'][self.checks[first[row]]] += 1
+                continue
+            funnel['passed'] += 1
+            pitches = (profile.relative[row] + self.startPitch).tolist()
+            if self.cue:
+                pitches = self.cue + [Rest,] + pitches
+            self.search.offer(Motif(count, pitches, self.scaleId, self.fileBase))
+            offered += 1
+        funnel['offered'] += offered
+        return offered
+
+def writeFunnel(name, queries, scanSeconds):
+    ''' the --funnel JSON of the FunnelQuery queries '''
+    records = []
+    for query in queries:
+        records.extend(query.records())
+    f = open(name, 'w')
+    try:
+        json.dump(dict(scanSeconds=scanSeconds, funnels=records), f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+class NgramFileScan(object):
+    ''' One ngram file being read by scanNgrams: the row or block at its head,
+    the queries still reading it, and how many motifs each has taken from it '''
+    def __init__(self, i, queries, span=None):
+        self.i = i
+        self.queries = queries
+        self.kept = [0] * len(queries)
+        if useBlocks:
+            self.source = readNgramBlocks(i, span, self.skipBlock)
+        else:
+            self.source = readNgrams(i, span, self.skipBlock)
+        self.advance()
+        self.prune()
+
+    def skipBlock(self, maxCount, minLeap):
+        ''' a block store's block can be passed over unread if no query still
+        reading the file could take any of its ngrams, by count or by leap '''
+        for query in self.queries:
+            if not query.skipsBlocks:
+                return False
+            if (query.search.couldUse(maxCount)
+                and (query.conjunct == None or minLeap <= query.conjunct)):
+                return False
+        return True
+
+    def advance(self):
+        try:
+            self.head = self.source.next()
+            if useBlocks:
+                self.headCount = self.head[1][0]
+            else:
+                self.headCount = self.head[1]
+        except StopIteration:
+            self.head = None
+
+    def process(self):
+        ''' offer the head row or block to the queries and move on '''
+        changed = False
+        if useBlocks:
+            intervals, counts = self.head
+            profile = BlockProfile(intervals)
+            for k, query in enumerate(self.queries):
+                self.kept[k] += query.considerBlock(profile, counts, query.fill - self.kept[k])
+            changed = True
+        else:
+            ng, count = self.head
+            profile = NgramProfile(ng)
+            for k, query in enumerate(self.queries):
+                if query.consider(profile, count):
+                    self.kept[k] += 1
+                    changed = True
+        lastCount = self.headCount
+        self.advance()
+        if changed or self.head is None or self.headCount != lastCount:
+            self.prune()
+
+    def prune(self):
+        ''' drop the queries that have their fill from this file, or whose top
+        list the rest of the file, all at or below the head count, cannot beat '''
+        if self.head is None:
+            self.queries = []
+            return
+        queries = []
+        kept = []
+        for query, nKept in zip(self.queries, self.kept):
+            if nKept < query.fill and query.search.couldUse(self.headCount):
+                queries.append(query)
+                kept.append(nKept)
+        self.queries = queries
+        self.kept = kept
+
+    def close(self):
+        self.source.close()
+
+def scanNgrams(queries):
+    ''' Read all the ngram files side by side, most popular rows first across
+    them, offering every ngram to the queries wanting that size. Each file is
+    dropped as soon as none of its queries can use anything more from it. '''
+    if useTrie:
+        return scanTrie(queries)
+    sizes = set()
+    for query in queries:
+        sizes.update(xrange(query.minGrams, query.maxGrams+1))
+    heap = []
+    for i in sorted(sizes):
+        # the 14gram set could not be unzipped before reformatPetrucci read compressed inputs
+        if i == 14 and not haveNgrams(i):
+            continue
+        scan = NgramFileScan(i, [query for query in queries if query.wants(i)])
+        if scan.queries:
+            heap.append((-scan.headCount, i, scan))
+        else:
+            scan.close()
+    heapq.heapify(heap)
+    while heap:
+        negCount, i, scan = heapq.heappop(heap)
+        scan.process()
+        if scan.queries:
+            heapq.heappush(heap, (-scan.headCount, i, scan))
+        else:
+            scan.close()
+    return queries
+
+def scanTrie(queries):
+    ''' scanNgrams by walking a prefix trie of all the ngram sizes from each
+    start pitch, so ngrams sharing a prefix that breaks the chromatic, conjunct
+    or unison limit are all passed over at once '''
+    ngrams = dict()
+    for query in queries:
+        for i in xrange(query.minGrams, query.maxGrams+1):
+            if i == 14 and not haveNgrams(i):
+                continue
+            if i not in ngrams:
+                ngrams[i] = loadNgrams(i)
+    if not ngrams:
+        return queries
+    trie = ngramtrie.NgramTrie(dict([(i, intervals) for i, (intervals, counts) in ngrams.items()]))
+    for query in queries:
+        found = trie.walk(query.startPitch, query.scale.inScaleTable, query.nChromatics,
+                          query.conjunct, query.unisons, query.minGrams, query.maxGrams)
+        for i in sorted(found):
+            if i not in ngrams:
+                continue
+            intervals, counts = ngrams[i]
+            rows = found[i]     # in file order, so the per file fill is taken as scanNgrams takes it
+            query.considerBlock(BlockProfile(intervals[rows]), counts[rows], query.fill)
+    return queries
+
 def getTopMotifs(scale, nTop, minGrams, maxGrams, cue, startPitch,
                  conjunct, outside, unisons, minPcs, mustFix, mustSet,
                  nChromatics, begOrEndSet, poisonSets, poisonSequences, fileBase):
-    tops = []
-    for i in xrange(minGrams, maxGrams+1):
-        if i == 14:
+    query = MotifQuery(scale, nTop, minGrams, maxGrams, cue, startPitch,
+                       conjunct, outside, unisons, minPcs, mustFix, mustSet,
+                       nChromatics, begOrEndSet, poisonSets, poisonSequences, fileBase)
+    search = MotifSearch(nTop, [query])
+    scanNgrams([query])
+    return search.getTops()
+
+# bumped whenever a change to the search would change what it finds
+cacheVersion = 2
+
+def searchCacheKey(cache, scaleClassname, scale, startPitches, queryArgs, seed=None):
+    ''' MotifCache key of one scale's search: the scale, its start pitches, every
+    query setting, the seed if it samples and the identity of each ngram file
+    it reads. The file base only names the output, and is given to the motifs
+    again when they come out of the cache. '''
+    settings = []
+    for name, value in sorted(queryArgs.items()):
+        if name == 'fileBase':
             continue
-        name = os.path.abspath(Petrucci + "/ngram%d.csv" % (i,))
+        elif name == 'released':
+            if not value:
+                continue        # keys from before --released stay good
+            value = (os.path.abspath(value), motifhistory.openHistory(value).stamp())
+        elif isinstance(value, PcSet):
+            value = list(value)
+        elif isinstance(value, set):
+            value = sorted(value)
+        elif name == 'poisonSets':
+            value = [ list(poisonSet) for poisonSet in value ]
+        settings.append((name, value))
+    files = []
+    for i in xrange(queryArgs['minGrams'], queryArgs['maxGrams']+1):
+        # a shared store is parsed from the .csv, so the .csv stands for it
+        name = localStoreName(i) or ngramFileName(i)
+        files.append((i, cache.fileIdentity(name)))
+    parts = (cacheVersion, scaleClassname, sorted(scale.stepToPc.items()),
+             list(startPitches), settings, files)
+    if seed is not None:
+        parts += (('seed', seed),)
+    return cache.key(parts)
 
-        f = open(name)
-        line = f.readline()
-        tried = 0
-        kept = 0
-        count = 99999999
-        while line:
-            line = line.rstrip()
-            ng, year, count = line.split('\t')
-            count = int(count)
-            ng = ng.split()
-            ng = map(int, ng)
-            ng = tuple(ng)
-            pitches = scale.mapNgramToScale(ng, startPitch,
-                                            conjunct, outside, unisons, minPcs,
-                                            mustFix, begOrEndSet, nChromatics)
-            tried += 1
-            if pitches:
-                pitchSequence = [x % 12 for x in pitches] 
-                pitchSet = set(pitchSequence)
-                if (avoidSets(pitchSet, poisonSets)
-                    and havePitches(pitchSequence, pitchSet, mustSet, nChromatics, scale.pitchSet)
-                    and avoidDouble(pitches)
-                    and avoidSequences(pitchSequence, poisonSequences)):
-
-                    #pdb.set_trace()
-                    if cue:
-                        pitches = cue + [Rest,] + pitches
-                    tops.append((count, pitches, scale, fileBase, None))
-                    kept += 1
-                    if kept >= nTop:
-                        break
-            line = f.readline()
-        f.close()
-        #print "%d notes, %d / %d" % (i+1, kept, tried)
-    tops.sort(reverse=True)
-    tops = tops[:nTop]
-    return tops
+def searchMotifs(work):
+    ''' searchInProcesses worker: the top motifs of one scale from some of its
+    start pitches, as (count, pitches) pairs '''
+    settings, scaleClassname, startPitches, queryArgs, seed = work
+    global Petrucci, useBlocks, useTrie, sharedNgrams
+    Petrucci, useBlocks, useTrie, sharedNgrams = settings
+    scale = globals()[scaleClassname]()
+    queries = [ MotifQuery(scale, startPitch=startPitch, **queryArgs) for startPitch in startPitches ]
+    search = makeSearch(scaleClassname, queryArgs['nTop'], seed)
+    for query in queries:
+        search.addQuery(query)
+    scanNgrams(queries)
+    return [ (motif.count, motif.pitches) for motif in search.getTops() ]
 
+def searchInProcesses(work, jobs):
+    ''' scanNgrams for several scales in jobs processes. work is a list of
+    (scaleClassname, scale, startPitches, queryArgs, search). The start pitches
+    of a scale are split among processes when there are fewer scales than jobs.
+    Each search is offered the top motifs of every part, so it ends up with the
+    same top list as a single scan of all its queries. '''
+    if not work:
+        return
+    nParts = max(1, -(-jobs // len(work)))
+    settings = (Petrucci, useBlocks, useTrie, sharedNgrams)
+    parts = []
+    searches = []
+    for scaleClassname, scale, startPitches, queryArgs, search in work:
+        for k in xrange(min(nParts, len(startPitches))):
+            parts.append((settings, scaleClassname, startPitches[k::nParts], queryArgs, search.seed))
+            searches.append((scale, queryArgs['fileBase'], search))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(searchMotifs, parts, 1)
+    finally:
+        pool.close()
+        pool.join()
+    for (scale, fileBase, search), found in zip(searches, results):
+        scaleId = getScaleId(scale)
+        for count, pitches in found:
+            search.offer(Motif(count, pitches, scaleId, fileBase))
+
+class SpanSearch(MotifSearch):
+    ''' Stands in for a MotifSearch in a searchSpans worker, keeping one query's
+    motifs from one span in file order. Whether they make the top list is only
+    known once every span has been read, so it never prunes. '''
+    def __init__(self):
+        self.found = []
+
+    def offer(self, motif):
+        self.found.append((motif.count, motif.pitches))
+
+    def couldUse(self, count):
+        return True
+
+def searchSpan(work):
+    ''' searchSpans worker: for each query, the motifs one span of an ngram file
+    gives it, up to its fill, as (count, pitches) pairs in file order '''
+    settings, i, span, scaleParts = work
+    global Petrucci, useBlocks, useTrie, sharedNgrams
+    Petrucci, useBlocks, useTrie, sharedNgrams = settings
+    queries = []
+    for scaleClassname, startPitches, queryArgs in scaleParts:
+        scale = globals()[scaleClassname]()
+        for startPitch in startPitches:
+            query = MotifQuery(scale, startPitch=startPitch, **queryArgs)
+            query.search = SpanSearch()
+            queries.append(query)
+    scan = NgramFileScan(i, list(queries), span)
+    while scan.queries:
+        scan.process()
+    scan.close()
+    return [ query.search.found for query in queries ]
+
+def searchSpans(work, jobs):
+    ''' scanNgrams in jobs processes, each reading one span of an ngram file for
+    all the queries. work is as for searchInProcesses. A query's motifs from a
+    file are those of its spans in file order, cut to its fill, so every search
+    is offered just what a single scan would have offered it. '''
+    if not work:
+        return
+    settings = (Petrucci, useBlocks, useTrie, sharedNgrams)
+    sizes = set()
+    for scaleClassname, scale, startPitches, queryArgs, search in work:
+        sizes.update(xrange(queryArgs['minGrams'], queryArgs['maxGrams']+1))
+    parts = []
+    files = []
+    for i in sorted(sizes):
+        if i == 14 and not haveNgrams(i):
+            continue
+        scaleParts = []
+        queries = []
+        for scaleClassname, scale, startPitches, queryArgs, search in work:
+            if queryArgs['minGrams'] <= i <= queryArgs['maxGrams']:
+                scaleParts.append((scaleClassname, startPitches, queryArgs))
+                queries.extend([ (getScaleId(scale), queryArgs, search) ] * len(startPitches))
+        spans = ngramSpans(i, jobs)
+        for span in spans:
+            parts.append((settings, i, span, scaleParts))
+        files.append((queries, len(spans)))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(searchSpan, parts, 1)
+    finally:
+        pool.close()
+        pool.join()
+    for queries, nSpans in files:
+        spanResults, results = results[:nSpans], results[nSpans:]
+        for k, (scaleId, queryArgs, search) in enumerate(queries):
+            found = []
+            for spanFound in spanResults:
+                found.extend(spanFound[k])
+            # at least one, as for a query wanting no motifs at all in scanNgrams
+            for count, pitches in found[:max(queryArgs['nTop'], 1)]:
+                search.offer(Motif(count, pitches, scaleId, queryArgs['fileBase']))
 
 def outputMotifsToFile(lfp, motifs, maker, doMarker, doDump, doPdb, nKeys, base0, settleTime, oneIn, sleepTime, scale, scaleClassname):
     #pdb.set_trace()
@@ -399,9 +1496,13 @@ def outputMotifsToFile(lfp, motifs, maker, doMarker, doDump, doPdb, nKeys, base0
         keyName = midi.getAsciiNoteName(key % 12).lower()
 
         nMotifs = len(motifs)
-        for index, tup in enumerate(motifs):
+        for index, record in enumerate(motifs):
             if (iKey + index) % oneIn == 0:
-                count, motif, scale, motifString, fileBase, footnote = tup
+                motif = record.pitches
+                scale = record.scale
+                motifString = record.name
+                fileBase = record.fileBase
+                footnote = record.footnote
                 startTime, startFrame = maker.getTime()
                 #pdb.set_trace()
                 maker.enqueueMotif(motif)
@@ -419,273 +1520,515 @@ def outputMotifsToFile(lfp, motifs, maker, doMarker, doDump, doPdb, nKeys, base0
                 lfp.write(u'%s\n' % (lf.join(logline),))
                 maker.skipSeconds(settleTime)                        
     
-if __name__ == '__main__':
-    options = ['help', 'pdb', 'petrucci=', 'scales=', 'top=', 'tempo=', 'sleep=',
-               'key=', 'keyOctave=', 'nKeys=', 'oneIn=',
-               'unisons=', 'conjunct=', 'minNotes=', 'maxNotes=', 'minPcs=',
-               'dump', 'starts=', 'must=', 'begorends=', 'fix',
-               'chromatics=', 'cue=',
-               'base=', 
-               'poisonSets=', 'poisonSequences=',
-               'dyads', 'ascending', 'descending', 'harmonic',
-   ]
-
-    def usage():
-        print "Options:"
-        for word in options:
-            print "  ", word
-        sys.exit(0)
-        
-    import getopt
-    def main():
-        top = 0
-        tempo = 60
-        scaleClassnames = ['Diatonic', 'Mixolydian', 'MajorChromatics',
-                           'Aeolian', 'Dorian', 'Phrygian', 'HarmonicMinor', 'MelodicMinor', 'MinorChromatics']
-        key = keyToBase['c']
-        keyOctave = 3
-        conjunct = 11
-        outside = None
-        unisons = 0
-        minNotes = 0
-        maxNotes = 0
-        nKeys = 12
-        oneIn = 12
-        minPcs = 0
-        doDump = False
-        startPitches = None
-        cue = None
-        mustSet = None
-        begOrEndSet = None
-        poisonSets = []
-        poisonSequences = []
-        nChromatics = 0
-        theFileBase = None
-        sleepTime = 2.0  # time padded to the end of motif in .wav sample
-        mustFixPosition = None
-        global running, selectAnother, pause, Petrucci
-        selectAnother = False
-        running = True
-        pause = False
-        doPdb = False
-        doAscending = False
-        doDescending = False
-        doHarmonic = False
+options = ['help', 'pdb', 'petrucci=', 'scales=', 'top=', 'tempo=', 'sleep=',
+           'key=', 'keyOctave=', 'nKeys=', 'oneIn=',
+           'unisons=', 'conjunct=', 'minNotes=', 'maxNotes=', 'minPcs=',
+           'dump', 'starts=', 'must=', 'begorends=', 'fix',
+           'chromatics=', 'cue=',
+           'base=', 
+           'poisonSets=', 'poisonSequences=',
+           'dyads', 'ascending', 'descending', 'harmonic',
+           'scalar', 'trie', 'jobs=', 'splitFiles', 'shareNgrams=', 'sample', 'seed=', 'released=', 'cache=', 'cacheMB=', 'manifest=', 'funnel=',
+]
 
-        #pdb.set_trace()
-        opts, pargs = getopt.getopt(sys.argv[1:], '', options)
-        for opt, val in opts:
-            if opt == '--help':
-                usage()
-            elif opt == '--pdb':
-                doPdb = True
-            elif opt == '--petrucci':
-                Petrucci = val
-            elif opt == '--scales':
-                if ',' in val:
-                    scaleClassnames = val.split(',')
-                else:
-                    scaleClassnames = [val, ]
-            elif opt == '--top':
-                top = int(val)
-            elif opt == '--tempo':
-                tempo = int(val)
-            elif opt == '--key':
-                key = keyToBase[val.lower()]
-            elif opt == '--keyOctave':
-                keyOctave = int(val)
-            elif opt == '--nKeys':
-                nKeys = int(val) # number of keys to chromatically step up when generating
-            elif opt == '--oneIn':
-                oneIn = int(val)
-            elif opt == '--conjunct':
-                conjunct = int(val)
-            elif opt == '--minNotes':
-                minNotes = int(val)
-            elif opt == '--maxNotes':
-                maxNotes = int(val)
-            elif opt == '--unisons':
-                unisons = int(val)
-            elif opt == '--minPcs':
-                minPcs = int(val)
-            elif opt == '--dump':
-                doDump = True
-            elif opt == '--starts':
-                startPitches = val
-            elif opt == '--base':
-                theFileBase = val
-            elif opt == '--must':
-                mustSet = set(map(int, val.split(',')))
-            elif opt == '--begorends':
-                begOrEndSet = set(map(int, val.split(',')))
-            elif opt == '--chromatics':
-                nChromatics = int(val)
-            elif opt == '--cue':
-                cue = map(int, val.split(','))
-            elif opt == '--poisonSets':
-                poisonStrings = val.split(':')
-                poisonSets = []
-                for ps in poisonStrings:
-                    poisonSets.append(set(map(int, ps.split(','))))
-            elif opt == '--poisonSequences':
-                poisonStrings = val.split(':')
-                poisonSequences = []
-                for ps in poisonStrings:
-                    poisonSequences.append(map(int, ps.split(',')))
-            elif opt == '--fix':
-                mustFixPosition = True
-            elif opt == '--sleep':
-                sleepTime = float(val)
-            elif opt == '--dyads':
-                scaleClassnames = ['Dyad', ]
-                theFileBase = 'dy'
-                cue = [0, 7, 12]
-                oneIn = 4
-            elif opt == '--ascending':
-                doAscending = True
-                theFileBase = 'dya'
-            elif opt == '--descending':
-                doDescending = True
-                theFileBase = 'dyd'
-            elif opt == '--harmonic':
-                doHarmonic = True
-                theFileBase = 'dyh'
+def usage():
+    print "Options:"
+    for word in options:
+        print "  ", word
+    sys.exit(0)
+
+class Settings(object):
+    ''' everything the command line options set, at their defaults '''
+    def __init__(self):
+        self.top = 0
+        self.tempo = 60
+        self.scaleClassnames = ['Diatonic', 'Mixolydian', 'MajorChromatics',
+                                'Aeolian', 'Dorian', 'Phrygian', 'HarmonicMinor', 'MelodicMinor', 'MinorChromatics']
+        self.key = keyToBase['c']
+        self.keyOctave = 3
+        self.conjunct = 11
+        self.outside = None
+        self.unisons = 0
+        self.minNotes = 0
+        self.maxNotes = 0
+        self.nKeys = 12
+        self.oneIn = 12
+        self.minPcs = 0
+        self.doDump = False
+        self.startPitches = None
+        self.cue = None
+        self.mustSet = None
+        self.begOrEndSet = None
+        self.poisonSets = []
+        self.poisonSequences = []
+        self.nChromatics = 0
+        self.fileBase = None
+        self.sleepTime = 2.0  # time padded to the end of motif in .wav sample
+        self.mustFixPosition = None
+        self.doPdb = False
+        self.doAscending = False
+        self.doDescending = False
+        self.doHarmonic = False
+        self.jobs = 1
+        self.splitFiles = False
+        self.sharedNgrams = None
+        self.sample = False
+        self.seed = None
+        self.released = None
+        self.cacheDirectory = None
+        self.cacheMB = motifcache.defaultMaxBytes >> 20
+        self.manifest = None
+        self.funnel = None
+        self.petrucci = Petrucci
+        self.useBlocks = numpy is not None
+        self.useTrie = False
+
+    def sampleSeed(self):
+        ''' the seed to sample the motifs with, or None for the top lists '''
+        if self.sample:
+            return self.seed
+        return None
+
+def parseOptions(argv):
+    ''' Settings for a genmotifs command line '''
+    settings = Settings()
+    #pdb.set_trace()
+    opts, pargs = getopt.getopt(argv, '', options)
+    for opt, val in opts:
+        if opt == '--help':
+            usage()
+        elif opt == '--pdb':
+            settings.doPdb = True
+        elif opt == '--petrucci':
+            settings.petrucci = val
+        elif opt == '--scales':
+            if ',' in val:
+                settings.scaleClassnames = val.split(',')
             else:
-                print opt,val
-                raise Exception, '%s %s?' % (opt,val)
+                settings.scaleClassnames = [val, ]
+        elif opt == '--top':
+            settings.top = int(val)
+        elif opt == '--tempo':
+            settings.tempo = int(val)
+        elif opt == '--key':
+            settings.key = keyToBase[val.lower()]
+        elif opt == '--keyOctave':
+            settings.keyOctave = int(val)
+        elif opt == '--nKeys':
+            settings.nKeys = int(val) # number of keys to chromatically step up when generating
+        elif opt == '--oneIn':
+            settings.oneIn = int(val)
+        elif opt == '--conjunct':
+            settings.conjunct = int(val)
+        elif opt == '--minNotes':
+            settings.minNotes = int(val)
+        elif opt == '--maxNotes':
+            settings.maxNotes = int(val)
+        elif opt == '--unisons':
+            settings.unisons = int(val)
+        elif opt == '--minPcs':
+            settings.minPcs = int(val)
+        elif opt == '--dump':
+            settings.doDump = True
+        elif opt == '--starts':
+            settings.startPitches = val
+        elif opt == '--base':
+            settings.fileBase = val
+        elif opt == '--must':
+            settings.mustSet = PcSet(map(int, val.split(',')))
+        elif opt == '--begorends':
+            settings.begOrEndSet = set(map(int, val.split(',')))
+        elif opt == '--chromatics':
+            settings.nChromatics = int(val)
+        elif opt == '--cue':
+            settings.cue = map(int, val.split(','))
+        elif opt == '--poisonSets':
+            poisonStrings = val.split(':')
+            settings.poisonSets = []
+            for ps in poisonStrings:
+                settings.poisonSets.append(PcSet(map(int, ps.split(','))))
+        elif opt == '--poisonSequences':
+            poisonStrings = val.split(':')
+            settings.poisonSequences = []
+            for ps in poisonStrings:
+                settings.poisonSequences.append(map(int, ps.split(',')))
+        elif opt == '--fix':
+            settings.mustFixPosition = True
+        elif opt == '--sleep':
+            settings.sleepTime = float(val)
+        elif opt == '--dyads':
+            settings.scaleClassnames = ['Dyad', ]
+            settings.fileBase = 'dy'
+            settings.cue = [0, 7, 12]
+            settings.oneIn = 4
+        elif opt == '--ascending':
+            settings.doAscending = True
+            settings.fileBase = 'dya'
+        elif opt == '--descending':
+            settings.doDescending = True
+            settings.fileBase = 'dyd'
+        elif opt == '--harmonic':
+            settings.doHarmonic = True
+            settings.fileBase = 'dyh'
+        elif opt == '--scalar':
+            settings.useBlocks = False   # per ngram Python filters even with numpy
+        elif opt == '--trie':
+            if numpy is None:
+                raise Exception, '--trie needs numpy'
+            settings.useTrie = True
+        elif opt == '--jobs':
+            settings.jobs = int(val)
+        elif opt == '--splitFiles':
+            settings.splitFiles = True
+        elif opt == '--shareNgrams':
+            settings.sharedNgrams = val
+        elif opt == '--sample':
+            settings.sample = True
+        elif opt == '--seed':
+            settings.seed = int(val)
+        elif opt == '--released':
+            settings.released = val
+        elif opt == '--cache':
+            settings.cacheDirectory = val
+        elif opt == '--cacheMB':
+            settings.cacheMB = int(val)
+        elif opt == '--manifest':
+            settings.manifest = val
+        elif opt == '--funnel':
+            settings.funnel = val
+        else:
+            print opt,val
+            raise Exception, '%s %s?' % (opt,val)
 
-        if len(pargs) > 0:
-            raise Exception, '%s?' % [str(pargs),]
-            
-        # set tonic for first scale (though this gets set again anyway)
-        base0 = 60 + key + (keyOctave - 4) * 12
-        maker = midimaker.Maker(base0, tempo)
+    if len(pargs) > 0:
+        raise Exception, '%s?' % [str(pargs),]
 
-        # command line overrides defaults
-        if theFileBase == None:
-            theFileBase = 'gm'
+    # command line overrides defaults
+    if settings.fileBase == None:
+        settings.fileBase = 'gm'
 
-        lfp = codecs.open(theFileBase + '.log', 'w', 'utf_16')
-            
-        doMarker = True
+    if settings.funnel and settings.jobs > 1:
+        raise Exception, '--funnel counts in one process, without --jobs'
+    if settings.splitFiles and settings.useTrie:
+        raise Exception, '--splitFiles reads spans of the files, which --trie does not'
+    if settings.sample and settings.splitFiles:
+        raise Exception, '--sample does not go with --splitFiles, whose processes would send back every candidate'
+    if settings.sample and settings.seed == None:
+        settings.seed = random.randrange(1 << 32)
 
-        motifs = []
+    # I doubt that nChromatics > 0 is compatible with mustFixPosition
+    if settings.nChromatics > 0 and settings.mustFixPosition:
+        raise Exception, 'nChromatics > 0 and mustFixPosition'
+    return settings
 
-        # I doubt that nChromatics > 0 is compatible with mustFixPosition
-        if nChromatics > 0 and mustFixPosition:
-            raise Exception, 'nChromatics > 0 and mustFixPosition'
-
-        for scaleClassname in scaleClassnames:
-            if scaleClassname == 'Dyad':
-                if doPdb:
-                    pdb.set_trace()
-                scale = Chromatic()
-                lowTonic = 0
-                highTonic = 12
-                for interval in xrange(1, 12):
-                    iName = intervalName[interval]
-                    fileBase = '%s_%s' % (theFileBase, iName)
-                    footnote = iName
-                    shortHalf = interval / 2
-                    longHalf = interval - shortHalf
-                    for i in xrange(lowTonic - shortHalf, highTonic - longHalf + 1):
-                        j = i + interval
-                        if doAscending:
-                            pitches = [i, j]
-                        elif doDescending:
-                            pitches = [j, i]
-                        elif doHarmonic:
-                            pitches = [ ChordDelimiter, i, j, ChordDelimiter ] + [Rest,] + [ ChordDelimiter, i, j, ChordDelimiter ]
-                        else:
-                            if cue:
-                                rcue = [Rest,] + cue
-                            else:
-                                rcue = []
-                            pitches = [ i, j ] + rcue + [Rest,] + [ j, i ] + rcue + [Rest,] + [ ChordDelimiter, i, j, ChordDelimiter ] + [Rest,] + [ ChordDelimiter, i, j, ChordDelimiter ]
-                        if cue:
-                            pitches = cue + [Rest,] + pitches
-                        motifs.append( (1, pitches, scale, fileBase, footnote) )
-            else:
-                scale = globals()[scaleClassname]()
-                if doPdb:
-                    pdb.set_trace()
-                if mustSet == None:
-                    scaleMustSet = scale.mustPitches
-                else:
-                    scaleMustSet = mustSet
-                if startPitches:
-                    scaleStartPitches = map(int, startPitches.split(','))
-                else:
-                    scaleStartPitches = scale.getPitches()
-                if mustFixPosition == None:
-                    scaleMustFixPosition = scale.mustFixPosition
-                else:
-                    scaleMustFixPosition = mustFixPosition
-                if nChromatics == 0:
-                    scaleNChromatics = scale.nChromatics
-                else:
-                    scaleNChromatics = nChromatics
-                if minNotes == 0:
-                    minGrams = scale.minNotes - 1
-                else:
-                    minGrams = minNotes - 1
-                if maxNotes == 0:
-                    maxGrams = scale.maxNotes - 1
-                else:
-                    maxGrams = maxNotes - 1
-                if minPcs == 0:
-                    scaleMinPcs = scale.minPcs
-                else:
-                    scaleMinPcs = minPcs
-                if cue == None:
-                    scaleCue = scale.cue
-                else:
-                    scaleCue = cue
-                if top == 0:
-                    scaleTop = scale.top
+def findMotifs(settings):
+    ''' The motifs of each of the settings' scales, as (scaleClassname, scale,
+    motifs) with the motifs named and ready for outputMotifsToFile '''
+    return findMotifsTogether([settings])[0]
+
+def findMotifsTogether(settingsList):
+    ''' findMotifs for several settings, with a single scan of the ngram files
+    serving all of their searches '''
+    return [ list(found) for found in streamMotifsTogether(settingsList) ]
+
+def streamMotifsTogether(settingsList):
+    ''' findMotifsTogether, but with an iterator for each of the settings that
+    names the motifs of one scale at a time, letting each top list go once it
+    has been used '''
+    first = settingsList[0]
+    scanSettings = (first.petrucci, first.useBlocks, first.useTrie, first.jobs, first.splitFiles,
+                    first.sharedNgrams)
+    for settings in settingsList:
+        if (settings.petrucci, settings.useBlocks, settings.useTrie, settings.jobs, settings.splitFiles,
+            settings.sharedNgrams) != scanSettings:
+            raise Exception, ('settings sharing a scan must agree on --petrucci, --scalar, --trie, --jobs,'
+                              ' --splitFiles and --shareNgrams')
+    global Petrucci, useBlocks, useTrie, sharedNgrams
+    Petrucci = first.petrucci
+    # --funnel counts what a row by row scan reads, which reading a block at a
+    # time from each file would not give
+    useBlocks = first.useBlocks and not [settings for settings in settingsList if settings.funnel]
+    useTrie = first.useTrie
+    sharedNgrams = first.sharedNgrams
+
+    # one merged pass over the ngram files serves every scale and start pitch
+    plans = [ planSearches(settings) for settings in settingsList ]
+    queries = []
+    work = []
+    for searches, planQueries, planWork, toCache in plans:
+        queries.extend(planQueries)
+        work.extend(planWork)
+    start = time.time()
+    if first.jobs > 1 and first.splitFiles:
+        searchSpans(work, first.jobs)
+    elif first.jobs > 1:
+        searchInProcesses(work, first.jobs)
+    else:
+        scanNgrams(queries)
+    scanSeconds = time.time() - start
+    funnels = {}
+    for settings, plan in zip(settingsList, plans):
+        if settings.funnel:
+            funnels.setdefault(settings.funnel, []).extend(plan[1])
+    for name, funnelQueries in funnels.items():
+        writeFunnel(name, funnelQueries, scanSeconds)
+    for searches, planQueries, planWork, toCache in plans:
+        for cache, key, search in toCache:
+            cache.put(key, [ (motif.count, motif.pitches) for motif in search.getTops() ])
+    return [ iterNamedMotifs(settings, plan[0]) for settings, plan in zip(settingsList, plans) ]
+
+def scaleQueryArgs(settings, scale):
+    ''' the start pitches of the settings for a scale, and the MotifQuery
+    arguments of each, where the scale's own defaults fill in the settings' '''
+    if settings.mustSet == None:
+        scaleMustSet = scale.mustPitches
+    else:
+        scaleMustSet = settings.mustSet
+    if settings.startPitches:
+        scaleStartPitches = map(int, settings.startPitches.split(','))
+    else:
+        scaleStartPitches = scale.getPitches()
+    if settings.mustFixPosition == None:
+        scaleMustFixPosition = scale.mustFixPosition
+    else:
+        scaleMustFixPosition = settings.mustFixPosition
+    if settings.nChromatics == 0:
+        scaleNChromatics = scale.nChromatics
+    else:
+        scaleNChromatics = settings.nChromatics
+    if settings.minNotes == 0:
+        minGrams = scale.minNotes - 1
+    else:
+        minGrams = settings.minNotes - 1
+    if settings.maxNotes == 0:
+        maxGrams = scale.maxNotes - 1
+    else:
+        maxGrams = settings.maxNotes - 1
+    if settings.minPcs == 0:
+        scaleMinPcs = scale.minPcs
+    else:
+        scaleMinPcs = settings.minPcs
+    if settings.cue == None:
+        scaleCue = scale.cue
+    else:
+        scaleCue = settings.cue
+    if settings.top == 0:
+        scaleTop = scale.top
+    else:
+        scaleTop = settings.top
+
+    queryArgs = dict(nTop=scaleTop, minGrams=minGrams, maxGrams=maxGrams, cue=scaleCue,
+                     conjunct=settings.conjunct, outside=settings.outside, unisons=settings.unisons,
+                     minPcs=scaleMinPcs, mustFix=scaleMustFixPosition, mustSet=scaleMustSet,
+                     nChromatics=scaleNChromatics, begOrEndSet=settings.begOrEndSet,
+                     poisonSets=settings.poisonSets, poisonSequences=settings.poisonSequences,
+                     fileBase=settings.fileBase, released=settings.released)
+    return scaleStartPitches, queryArgs
+
+def planSearches(settings):
+    ''' The searches for the settings' scales, None for Dyad, as (scale,
+    MotifSearch) pairs, along with the queries or searchInProcesses work that
+    will fill them and the (cache, key, search) entries to store afterwards.
+    Searches found in the cache are filled already. '''
+    doPdb = settings.doPdb
+    theFileBase = settings.fileBase
+    searches = []
+    queries = []
+    work = []
+    cache = None
+    if settings.cacheDirectory:
+        cache = motifcache.MotifCache(settings.cacheDirectory, settings.cacheMB << 20)
+    toCache = []
+    for scaleClassname in settings.scaleClassnames:
+        if scaleClassname == 'Dyad':
+            searches.append(None)
+            continue
+        scale = globals()[scaleClassname]()
+        if doPdb:
+            pdb.set_trace()
+        scaleStartPitches, queryArgs = scaleQueryArgs(settings, scale)
+        scaleTop = queryArgs['nTop']
+        search = makeSearch(scaleClassname, scaleTop, settings.sampleSeed())
+        searches.append((scale, search))
+        if cache:
+            key = searchCacheKey(cache, scaleClassname, scale, scaleStartPitches, queryArgs, search.seed)
+            found = cache.get(key)
+            if found is not None:
+                for count, pitches in found:
+                    search.offer(Motif(count, pitches, getScaleId(scale), theFileBase))
+                continue
+            toCache.append((cache, key, search))
+        if settings.jobs > 1:
+            work.append((scaleClassname, scale, scaleStartPitches, queryArgs, search))
+        else:
+            for startPitch in scaleStartPitches:
+                if settings.funnel:
+                    query = FunnelQuery(scale, startPitch=startPitch, **queryArgs)
                 else:
-                    scaleTop = top
+                    query = MotifQuery(scale, startPitch=startPitch, **queryArgs)
+                search.addQuery(query)
+                queries.append(query)
+    return searches, queries, work, toCache
 
-                #pdb.set_trace()
-                for startPitch in scaleStartPitches:
-                    tops = getTopMotifs(scale, scaleTop, minGrams, maxGrams, scaleCue, startPitch,
-                                        conjunct, outside, unisons,
-                                        scaleMinPcs, scaleMustFixPosition, scaleMustSet,
-                                        scaleNChromatics, begOrEndSet, poisonSets, poisonSequences, theFileBase)
-                    motifs.extend(tops)
+def iterNamedMotifs(settings, searches):
+    ''' the findMotifs result from the filled searches of planSearches, a
+    scale at a time '''
+    doPdb = settings.doPdb
+    cue = settings.cue
+    theFileBase = settings.fileBase
+    for scaleClassname, search in zip(settings.scaleClassnames, searches):
+        motifs = []
+        if scaleClassname == 'Dyad':
+            if doPdb:
+                pdb.set_trace()
+            scale = Chromatic()
+            lowTonic = 0
+            highTonic = 12
+            for interval in xrange(1, 12):
+                iName = intervalName[interval]
+                fileBase = '%s_%s' % (theFileBase, iName)
+                footnote = iName
+                shortHalf = interval / 2
+                longHalf = interval - shortHalf
+                for i in xrange(lowTonic - shortHalf, highTonic - longHalf + 1):
+                    j = i + interval
+                    if settings.doAscending:
+                        pitches = [i, j]
+                    elif settings.doDescending:
+                        pitches = [j, i]
+                    elif settings.doHarmonic:
+                        pitches = [ ChordDelimiter, i, j, ChordDelimiter ] + [Rest,] + [ ChordDelimiter, i, j, ChordDelimiter ]
+                    else:
+                        if cue:
+                            rcue = [Rest,] + cue
+                        else:
+                            rcue = []
+                        pitches = [ i, j ] + rcue + [Rest,] + [ j, i ] + rcue + [Rest,] + [ ChordDelimiter, i, j, ChordDelimiter ] + [Rest,] + [ ChordDelimiter, i, j, ChordDelimiter ]
+                    if cue:
+                        pitches = cue + [Rest,] + pitches
+                    motifs.append(Motif(1, pitches, getScaleId(scale), fileBase, footnote))
+        else:
+            scale, search = search
+            motifs = search.getTops()
+            search.heap = []
 
-                #pdb.set_trace()
-                motifs.sort(reverse=True)
-                motifs = motifs[:scaleTop]
-
-            #pdb.set_trace()                
-            # sort by filename?
-            countSorted = motifs
-            motifs = []
-            motifStringSet = set()
-            for count, motif, scale, fileBase, footNote in countSorted:
-                motifString = scale.stringifyMotif(motif)
-                if motifString in motifStringSet:
-                    nameBase = motifString + '_'
-                    for i in xrange(15):
-                        motifString = nameBase+(chr(ord('a')+i))
-                        if motifString not in motifStringSet:
-                            break
-                if motifString in motifStringSet:
-                    continue
-                motifStringSet.add(motifString)
-                motifs.append( (count, motif, scale, motifString, fileBase, footNote) )
-
-            settleTime = 2.0 # time padded between samples
-            outputMotifsToFile(lfp, motifs, maker, doMarker, doDump, doPdb, nKeys, base0, settleTime, oneIn, sleepTime, scale, scaleClassname)
-
-        # put a marker at the end to force reaper to continue past the last sample
-        maker.addMotif([0,])
+        #pdb.set_trace()                
+        # sort by filename?
+        countSorted = motifs
+        motifs = []
+        motifStringSet = set()
+        for record in countSorted:
+            scale = record.scale
+            motifString = scale.stringifyMotif(record.pitches)
+            if motifString in motifStringSet:
+                nameBase = motifString + '_'
+                for i in xrange(15):
+                    motifString = nameBase+(chr(ord('a')+i))
+                    if motifString not in motifStringSet:
+                        break
+            if motifString in motifStringSet:
+                continue
+            motifStringSet.add(motifString)
+            record.name = motifString
+            motifs.append(record)
+        yield scaleClassname, scale, motifs
+
+def generate(settings, lfp, midiFile, keep=True):
+    ''' Find the motifs and write their log lines to lfp and the midi file to
+    midiFile, a name or an open seekable file. Returns what findMotifs found,
+    or if not keep, renders each scale as soon as it is named and returns None. '''
+    found = streamMotifsTogether([settings])[0]
+    if keep:
+        found = list(found)
+    renderMotifs(settings, found, lfp, midiFile)
+    if keep:
+        return found
 
+def renderMotifs(settings, found, lfp, midiFile):
+    ''' the output half of generate, writing the midi events of each motif as
+    it goes '''
+    global running, selectAnother, pause
+    selectAnother = False
+    running = True
+    pause = False
 
+    # set tonic for first scale (though this gets set again anyway)
+    base0 = 60 + settings.key + (settings.keyOctave - 4) * 12
+    maker = midimaker.Maker(base0, settings.tempo, out=midiFile)
+
+    doMarker = True
+
+    for scaleClassname, scale, motifs in found:
+        settleTime = 2.0 # time padded between samples
+        outputMotifsToFile(lfp, motifs, maker, doMarker, settings.doDump, settings.doPdb, settings.nKeys,
+                           base0, settleTime, settings.oneIn, settings.sleepTime, scale, scaleClassname)
+
+    # put a marker at the end to force reaper to continue past the last sample
+    maker.addMotif([0,])
+
+    #pdb.set_trace()
+    maker.endTrack()
+    maker.close()
+
+def jobArgs(job):
+    ''' genmotifs command line arguments of a manifest job or server request,
+    given either as a list of arguments or as an object of option names and
+    values, with true standing for options without a value. Later options can
+    override earlier ones, so an object must be read with loadJson to keep its
+    order. '''
+    if 'args' in job:
+        return [str(arg) for arg in job['args']]
+    args = []
+    for name, value in job.get('options', {}).items():
+        if value is True:
+            args.append('--' + str(name))
+        elif value is not False and value is not None:
+            args.extend(['--' + str(name), str(value)])
+    return args
+
+def loadJson(text):
+    ''' JSON with its objects as OrderedDicts, in the order written '''
+    return json.loads(text, object_pairs_hook=collections.OrderedDict)
+
+def generateManifest(argv):
+    ''' Run every job of the --manifest in argv, writing each job's .log and
+    .mid files. The manifest is a JSON list of jobs, or an object with one
+    under "jobs". A job has a name and its options as in jobArgs, which follow
+    the rest of argv. The name is its --base, even when an option such as
+    --dyads names the files itself. '''
+    settings = parseOptions(argv)
+    f = open(settings.manifest)
+    try:
+        manifest = loadJson(f.read())
+    finally:
+        f.close()
+    if isinstance(manifest, dict):
+        manifest = manifest['jobs']
+    settingsList = []
+    bases = set()
+    for job in manifest:
+        jobSettings = parseOptions(argv + jobArgs(job) + ['--base', str(job['name'])])
+        if jobSettings.fileBase in bases:
+            raise Exception, 'more than one job writes %s.log' % (jobSettings.fileBase,)
+        bases.add(jobSettings.fileBase)
+        settingsList.append(jobSettings)
+    if not settingsList:
+        return
+    for jobSettings, found in zip(settingsList, streamMotifsTogether(settingsList)):
+        lfp = codecs.open(jobSettings.fileBase + '.log', 'w', 'utf_16')
+        renderMotifs(jobSettings, found, lfp, jobSettings.fileBase + '.mid')
+        lfp.close()
+
+if __name__ == '__main__':
+    def main():
+        settings = parseOptions(sys.argv[1:])
+        if settings.manifest:
+            generateManifest(sys.argv[1:])
+            return
+        if settings.sample:
+            print 'sampling with --seed=%d' % (settings.seed,)
+        lfp = codecs.open(settings.fileBase + '.log', 'w', 'utf_16')
+        generate(settings, lfp, settings.fileBase + '.mid', keep=False)
         lfp.close()
-        #pdb.set_trace()
-        maker.endTrack()
-        maker.write(theFileBase + '.mid')
         
-main()
+    main()
@@ -1,3 +1,4 @@
+import struct
 import midifile, midi
 
 frameRate = 44100
@@ -27,10 +28,52 @@ valueToTicksFactor = dict([('w', (4,1)), ('h', (2,1) ), ('q', (1,1)),
                            ('e', (1,2)), ('s', (1,4)), ('t', (1/32)),
                            ('Q', (2,3)), ('E', (1,3))])
 
+class StreamWriter(midifile.FileWriter):
+    ''' Writes a one track midi file as its events come in, rather than from a
+    whole Pattern, and patches the track length in when closed. The file, a name
+    or an open seekable file, is only opened when the first events arrive. '''
+    def __init__(self, midiFile, resolution):
+        self.midiFile = midiFile
+        self.resolution = resolution
+        self.f = None
+        self.length = 0
+        self.RunningStatus = None
+
+    def open(self):
+        if isinstance(self.midiFile, basestring):
+            self.f = open(self.midiFile, 'wb')
+        else:
+            self.f = self.midiFile
+        self.write_file_header(self.f, midifile.Pattern([midifile.Track()], resolution=self.resolution))
+        self.lengthOffset = self.f.tell() + 4
+        self.f.write(self.encode_track_header(0))
+
+    def writeEvents(self, events):
+        if self.f is None:
+            self.open()
+        buf = ''.join([ self.encode_midi_event(event) for event in events ])
+        self.f.write(buf)
+        self.length += len(buf)
+
+    def close(self):
+        if self.f is None:
+            self.open()
+        end = self.f.tell()
+        self.f.seek(self.lengthOffset)
+        self.f.write(struct.pack('>L', self.length))
+        self.f.seek(end)
+        if self.f is not self.midiFile:
+            self.f.close()
+
 class Maker(object):
-    def __init__(self, tonic, bpm, debug = False):
+    def __init__(self, tonic, bpm, debug = False, out = None):
         self.debug = debug
         self.resolution = 96  # ticks per quarter note
+        # with out, a midi file name or open file, events are written as each
+        # motif is flushed instead of kept in the pattern until write()
+        self.writer = None
+        if out is not None:
+            self.writer = StreamWriter(out, self.resolution)
         # final sorted midi events, where ticks are delta from the previous event
         self.pattern = midifile.Pattern(resolution=self.resolution)
         self.track = midifile.Track()
@@ -150,9 +193,17 @@ class Maker(object):
         self.queue = [ x for x in self.queue if x.pitch >= 0 ]
         self.track.extend(self.queue)
         self.queue = []
-        
+        self.drain()
+
+    def drain(self):
+        ''' pass the events so far to the stream writer, if there is one '''
+        if self.writer is not None and self.track:
+            self.writer.writeEvents(self.track)
+            del self.track[:]
+
     def endTrack(self):
         self.track.append(midifile.EndOfTrackEvent(tick=1))
+        self.drain()
 
     def getTime(self):
         secPerTick = (60.0 / self.bpm) / self.resolution
@@ -164,6 +215,11 @@ class Maker(object):
     def write(self, fname):
         midifile.write_midifile(fname, self.pattern)
 
+    def close(self):
+        ''' finish the file of a streaming maker '''
+        self.drain()
+        self.writer.close()
+
     def dump(self):
         midi.dumpmidi(self.pattern)
 
@@ -0,0 +1,115 @@
+import os, hashlib, marshal, tempfile
+
+# On disk cache of genmotifs search results, so that reruns changing only the
+# rendering options (tempo, key, sleep, ...) skip the ngram scan.
+#
+# Each entry is one scale's top list, marshalled into <key>.motifs where key is
+# the sha1 of everything the search depends on. A hit touches its file, so the
+# modification times order the entries for least recently used eviction.
+# Content hashes of the ngram files are remembered in stores.marshal by path,
+# size and modification time, and only worked out again when those change.
+
+suffix = '.motifs'
+storesName = 'stores.marshal'
+defaultMaxBytes = 100 << 20
+
+class MotifCache(object):
+    def __init__(self, directory, maxBytes=defaultMaxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.stores = None
+        self.evict()            # in case maxBytes went down
+
+    def entryName(self, key):
+        return os.path.join(self.directory, key + suffix)
+
+    def fileIdentity(self, name):
+        ''' (size, mtime, sha1 of the contents) of a file, or None if it is missing '''
+        if not os.path.exists(name):
+            return None
+        if self.stores is None:
+            self.stores = self.load(os.path.join(self.directory, storesName), {})
+        name = os.path.abspath(name)
+        st = os.stat(name)
+        known = self.stores.get(name)
+        if known and known[:2] == (st.st_size, st.st_mtime):
+            return known
+        digest = hashlib.sha1()
+        f = open(name, 'rb')
+        try:
+            while True:
+                data = f.read(1 << 20)
+                if not data:
+                    break
+                digest.update(data)
+        finally:
+            f.close()
+        identity = (st.st_size, st.st_mtime, digest.hexdigest())
+        self.stores[name] = identity
+        self.save(os.path.join(self.directory, storesName), self.stores)
+        return identity
+
+    def key(self, parts):
+        ''' parts must have a stable repr: tuples, lists, strings and numbers '''
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def get(self, key):
+        ''' the value put under key, or None '''
+        name = self.entryName(key)
+        value = self.load(name, None)
+        if value is not None:
+            os.utime(name, None)
+        return value
+
+    def put(self, key, value):
+        self.save(self.entryName(key), value)
+        self.evict()
+
+    def evict(self):
+        ''' drop the least recently used entries until they fit in maxBytes '''
+        entries = []
+        total = 0
+        for fn in os.listdir(self.directory):
+            if not fn.endswith(suffix):
+                continue
+            name = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue        # evicted by another run
+            entries.append((st.st_mtime, name, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for mtime, name, size in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+            total -= size
+
+    def load(self, name, default):
+        try:
+            f = open(name, 'rb')
+        except IOError:
+            return default
+        try:
+            try:
+                return marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return default  # cut short, treated as missing
+        finally:
+            f.close()
+
+    def save(self, name, value):
+        # written aside and renamed, so a reader never sees half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump(value, f)
+        finally:
+            f.close()
+        os.rename(tmp, name)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+import sys, os, struct, mmap, math, tempfile, getopt
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The motifs of earlier releases, so genmotifs can leave them out of new ones.
+#
+# A motif's identity is its scale's class name and Scale.stringifyMotif, as in
+# "Diatonic 1351_543714". A history directory holds
+#     released.txt    every identity released so far, sorted, one per line
+#     released.bloom  a Bloom filter of them: a header of magic, version,
+#                     number of hashes, number of bits and number of
+#                     identities, then the bits
+# A lookup probes the filter, and only reads released.txt, by binary search,
+# for the few identities the filter passes. Both files are memory mapped, so
+# a lookup costs the same however long the history grows.
+
+magic = 'BLMF'
+version = 1
+header = struct.Struct('<4sHHQQ')
+bloomName = 'released.bloom'
+exactName = 'released.txt'
+falsePositiveRate = 0.01
+
+mask64 = (1 << 64) - 1
+
+def mix64(z):
+    ''' the splitmix64 finalizer '''
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & mask64
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & mask64
+    return z ^ (z >> 31)
+
+def mix64Block(z):
+    ''' mix64 over a numpy uint64 array '''
+    z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94d049bb133111eb)
+    return z ^ (z >> numpy.uint64(31))
+
+def identityHash(identity):
+    h = mix64(len(identity))
+    for c in identity:
+        h = mix64(h ^ ord(c))
+    return h
+
+def identityHashBlock(prefix, codes):
+    ''' identityHash of prefix followed by each row of codes, a 2-D numpy array
+    of character codes '''
+    h = mix64(len(prefix) + codes.shape[1])
+    for c in prefix:
+        h = mix64(h ^ ord(c))
+    hashes = numpy.empty(len(codes), dtype=numpy.uint64)
+    hashes.fill(h)
+    codes = codes.astype(numpy.uint64)
+    for column in xrange(codes.shape[1]):
+        hashes = mix64Block(hashes ^ codes[:, column])
+    return hashes
+
+def bloomSize(n):
+    ''' (bits, hashes) of a filter of n identities at falsePositiveRate '''
+    nBits = max(64, int(-max(n, 1) * math.log(falsePositiveRate) / math.log(2) ** 2))
+    nBits = (nBits + 7) & ~7
+    # as many as a filter of exactly that size would use, not more for the
+    # rounding up of a small one
+    nHashes = max(1, int(round(-math.log(falsePositiveRate) / math.log(2))))
+    return nBits, nHashes
+
+def probes(h, nHashes, nBits):
+    ''' the bit positions of a hash, by double hashing '''
+    h1 = h & 0xffffffff
+    h2 = (h >> 32) | 1
+    return [ (h1 + i * h2) % nBits for i in xrange(nHashes) ]
+
+def mapFile(name):
+    ''' the contents of a file, memory mapped, and the identity of the file
+    mapped: (inode, size, mtime) '''
+    f = open(name, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        identity = (st.st_ino, st.st_size, st.st_mtime)
+        if st.st_size == 0:
+            return '', identity
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), identity
+    finally:
+        f.close()
+
+def fileStamp(directory):
+    ''' the identities of a history's files as they are now on disk '''
+    stamp = []
+    for name in [bloomName, exactName]:
+        st = os.stat(os.path.join(directory, name))
+        stamp.append((st.st_ino, st.st_size, st.st_mtime))
+    return tuple(stamp)
+
+class ReleaseHistory(object):
+    ''' a history directory, as its files were when loaded. Only create makes
+    a new one, so a mistyped directory is an error rather than an empty history. '''
+    def __init__(self, directory, create=False):
+        self.directory = directory
+        if not os.path.exists(os.path.join(directory, exactName)):
+            if not create:
+                raise Exception, 'no release history in %s' % (directory,)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.add([])
+        self.load()
+
+    def load(self):
+        self.bloom, bloomIdentity = mapFile(os.path.join(self.directory, bloomName))
+        tag, fileVersion, self.nHashes, self.nBits, self.count = header.unpack_from(self.bloom, 0)
+        if tag != magic or fileVersion != version:
+            raise Exception, '%s is not a version %d release history' % (self.directory, version)
+        if numpy is not None:
+            self.bits = numpy.frombuffer(self.bloom, dtype=numpy.uint8, offset=header.size)
+        self.exact, exactIdentity = mapFile(os.path.join(self.directory, exactName))
+        self.loadedStamp = (bloomIdentity, exactIdentity)
+
+    def stamp(self):
+        ''' the identities of the files loaded, as fileStamp gives them '''
+        return self.loadedStamp
+
+    def mayHold(self, h):
+        bloom = self.bloom
+        for bit in probes(h, self.nHashes, self.nBits):
+            if not ord(bloom[header.size + (bit >> 3)]) & (1 << (bit & 7)):
+                return False
+        return True
+
+    def holds(self, identity):
+        ''' binary search of released.txt '''
+        exact = self.exact
+        lo = 0
+        hi = len(exact)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = exact.rfind('\n', 0, mid) + 1
+            end = exact.find('\n', start)
+            if end < 0:
+                end = len(exact)
+            line = exact[start:end]
+            if line == identity:
+                return True
+            if line < identity:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+    def __contains__(self, identity):
+        return self.mayHold(identityHash(identity)) and self.holds(identity)
+
+    def containsBlock(self, prefix, codes):
+        ''' for each row of codes, whether prefix followed by the row's
+        characters was released '''
+        hashes = identityHashBlock(prefix, codes)
+        nBits = numpy.uint64(self.nBits)
+        h1 = hashes & numpy.uint64(0xffffffff)
+        h2 = (hashes >> numpy.uint64(32)) | numpy.uint64(1)
+        maybe = numpy.ones(len(codes), dtype=bool)
+        for i in xrange(self.nHashes):
+            bits = (h1 + numpy.uint64(i) * h2) % nBits
+            maybe &= (self.bits[bits >> numpy.uint64(3)] & (1 << (bits & numpy.uint64(7)).astype(numpy.uint8))) != 0
+        held = numpy.zeros(len(codes), dtype=bool)
+        for row in numpy.flatnonzero(maybe).tolist():
+            held[row] = self.holds(prefix + codes[row].astype(numpy.uint8).tostring())
+        return held
+
+    def add(self, identities):
+        ''' merge identities into released.txt and rebuild the filter '''
+        exactPath = os.path.join(self.directory, exactName)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        out = os.fdopen(fd, 'wb')
+        count = 0
+        try:
+            for identity in mergeSorted(sorted(set(identities)), readLines(exactPath)):
+                out.write(identity + '\n')
+                count += 1
+        finally:
+            out.close()
+        os.rename(tmp, exactPath)
+
+        nBits, nHashes = bloomSize(count)
+        bits = bytearray(nBits >> 3)
+        for identity in readLines(exactPath):
+            for bit in probes(identityHash(identity), nHashes, nBits):
+                bits[bit >> 3] |= 1 << (bit & 7)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        out = os.fdopen(fd, 'wb')
+        try:
+            out.write(header.pack(magic, version, nHashes, nBits, count))
+            out.write(str(bits))
+        finally:
+            out.close()
+        os.rename(tmp, os.path.join(self.directory, bloomName))
+        if hasattr(self, 'bloom'):
+            self.load()
+
+def readLines(name):
+    ''' yield the lines of a file without their newlines, none if it is missing '''
+    if not os.path.exists(name):
+        return
+    f = open(name, 'rb')
+    try:
+        for line in f:
+            yield line.rstrip('\n')
+    finally:
+        f.close()
+
+def mergeSorted(a, b):
+    ''' the union of two sorted iterables, without duplicates '''
+    previous = None
+    a = iter(a)
+    b = iter(b)
+    x = next(a, None)
+    y = next(b, None)
+    while x is not None or y is not None:
+        if y is None or (x is not None and x <= y):
+            value = x
+            x = next(a, None)
+        else:
+            value = y
+            y = next(b, None)
+        if value != previous:
+            yield value
+            previous = value
+
+histories = {}
+
+def openHistory(directory):
+    ''' one ReleaseHistory per directory in a process, loaded again when
+    motifhistory.py has added to it since '''
+    history = histories.get(directory)
+    if history is None or history.stamp() != fileStamp(directory):
+        history = histories[directory] = ReleaseHistory(directory)
+    return history
+
+if __name__ == '__main__':
+    options = ['help', 'history=']
+
+    def usage():
+        print 'motifhistory.py [--history=DIR] LOG...'
+        print '    adds the motifs of genmotifs .log files to the release history in DIR'
+        print '    (default released), for genmotifs.py --released=DIR to leave out'
+        sys.exit(0)
+
+    def main():
+        import genmotifs
+        directory = 'released'
+        opts, pargs = getopt.getopt(sys.argv[1:], '', options)
+        for opt, val in opts:
+            if opt == '--help':
+                usage()
+            elif opt == '--history':
+                directory = val
+        identities = []
+        for name in pargs:
+            identities.extend(genmotifs.logIdentities(name))
+        history = ReleaseHistory(directory, create=True)
+        history.add(identities)
+        print '%d motifs released, %d bits, %d hashes' % (history.count, history.nBits, history.nHashes)
+
+    main()
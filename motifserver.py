@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import sys, os, json, base64, socket, SocketServer, codecs, StringIO, getopt, signal
+import genmotifs
+
+# A resident genmotifs that reads the ngram files once and then answers
+# generation requests over a Unix socket, so each one pays only for its search
+# and rendering.
+#
+# Requests and replies are single lines of JSON. A request holds the genmotifs
+# command line options as genmotifs.jobArgs takes them, either as a list of
+# arguments or as an object of option names and values, with true standing for
+# options without a value:
+#     {"args": ["--scales", "Diatonic,Aeolian", "--top", "50"]}
+#     {"options": {"scales": "Diatonic,Aeolian", "top": 50, "fix": true}}
+# The reply has the motifs found for each scale and the base64 bytes of the
+# .log and .mid files genmotifs.py would have written:
+#     {"base": "gm", "scales": [{"scale": "Diatonic", "motifs": [...]}, ...],
+#      "log": "...", "mid": "..."}
+# or {"error": "..."} if the request failed.
+
+# options a server cannot honor for a client. --cache would file results from
+# the ngrams read at start up under the identity of the files on disk now, and
+# --funnel would write its report here rather than send it to the client.
+refused = ['help', 'pdb', 'dump', 'petrucci=', 'manifest=', 'cache=', 'cacheMB=', 'funnel=']
+
+def motifRecords(found):
+    scales = []
+    for scaleClassname, scale, motifs in found:
+        records = []
+        for motif in motifs:
+            records.append(dict(count=motif.count, pitches=motif.pitches, name=motif.name,
+                                fileBase=motif.fileBase, footnote=motif.footnote))
+        scales.append(dict(scale=scaleClassname, motifs=records))
+    return scales
+
+class MotifServer(SocketServer.UnixStreamServer):
+    ''' Serves one request at a time, as genmotifs keeps its settings in globals '''
+    def __init__(self, path, petrucci, sizes):
+        genmotifs.Petrucci = petrucci
+        self.petrucci = petrucci
+        if genmotifs.numpy is not None:
+            genmotifs.loadResidentNgrams(sizes)
+        SocketServer.UnixStreamServer.__init__(self, path, MotifRequestHandler)
+
+    def generate(self, request):
+        args = genmotifs.jobArgs(request)
+        for opt, val in getopt.getopt(args, '', genmotifs.options)[0]:
+            if opt[2:] in refused or opt[2:] + '=' in refused:
+                raise Exception, '%s is not available from the server' % (opt,)
+        settings = genmotifs.parseOptions(args)
+        settings.petrucci = self.petrucci
+        logBuffer = StringIO.StringIO()
+        lfp = codecs.getwriter('utf_16')(logBuffer)
+        midiBuffer = StringIO.StringIO()
+        found = genmotifs.generate(settings, lfp, midiBuffer)
+        return dict(base=settings.fileBase, scales=motifRecords(found),
+                    log=base64.b64encode(logBuffer.getvalue()),
+                    mid=base64.b64encode(midiBuffer.getvalue()))
+
+class MotifRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.generate(genmotifs.loadJson(line))
+            except Exception, e:
+                reply = dict(error='%s: %s' % (e.__class__.__name__, e))
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+def sendRequest(path, request):
+    ''' the reply of the server at path to one request '''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        f = s.makefile('r+b')
+        f.write(json.dumps(request) + '\n')
+        f.flush()
+        reply = json.loads(f.readline())
+        f.close()
+    finally:
+        s.close()
+    if 'error' in reply:
+        raise Exception, reply['error']
+    return reply
+
+if __name__ == '__main__':
+    options = ['help', 'socket=', 'petrucci=', 'minNotes=', 'maxNotes=', 'send']
+
+    def usage():
+        print 'motifserver.py [--socket=PATH] [--petrucci=DIR] [--minNotes=N] [--maxNotes=N]'
+        print '    serves genmotifs requests, holding the ngram files of minNotes to maxNotes notes'
+        print 'motifserver.py [--socket=PATH] --send -- [genmotifs options]'
+        print '    has the server generate and writes the .log and .mid files here'
+        sys.exit(0)
+
+    def main():
+        path = 'motifserver.sock'
+        petrucci = genmotifs.Petrucci
+        minNotes = 2
+        maxNotes = 15
+        send = False
+        opts, pargs = getopt.getopt(sys.argv[1:], '', options)
+        for opt, val in opts:
+            if opt == '--help':
+                usage()
+            elif opt == '--socket':
+                path = val
+            elif opt == '--petrucci':
+                petrucci = val
+            elif opt == '--minNotes':
+                minNotes = int(val)
+            elif opt == '--maxNotes':
+                maxNotes = int(val)
+            elif opt == '--send':
+                send = True
+
+        if send:
+            reply = sendRequest(path, dict(args=pargs))
+            for ext in ['log', 'mid']:
+                f = open('%s.%s' % (reply['base'], ext), 'wb')
+                f.write(base64.b64decode(reply[ext]))
+                f.close()
+            return
+        if len(pargs) > 0:
+            raise Exception, '%s?' % [str(pargs),]
+
+        if os.path.exists(path):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(path)
+            except socket.error:
+                os.remove(path)     # left by a server that did not shut down
+            else:
+                raise Exception, 'a server is already listening on %s' % (path,)
+            finally:
+                s.close()
+        server = MotifServer(path, petrucci, xrange(minNotes - 1, maxNotes))
+        # a plain kill also cleans up the socket
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(path)
+
+    main()
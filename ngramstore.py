@@ -0,0 +1,381 @@
+import os, struct, mmap, shutil, tempfile, hashlib, fcntl, glob, zlib
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Binary form of the reformatted Petrucci ngram files.
+#
+# ngramN.bin holds a small header followed by two columns, both in the same
+# count descending order as ngramN.csv:
+#     header     magic, version, n, number of rows
+#     intervals  rows * n signed bytes, one fixed width row per ngram
+#     counts     rows unsigned 32 bit counts
+# Everything is little endian so the file can be memory mapped and read in
+# place without any parsing.
+
+magic = 'NGRM'
+version = 1
+header = struct.Struct('<4sHHQ')
+countFormat = 'I'
+countSize = struct.calcsize('<' + countFormat)
+maxCount = 2**32 - 1
+
+def storeName(directory, n):
+    return os.path.join(directory, 'ngram%d.bin' % (n,))
+
+class StoreWriter(object):
+    ''' Writes an ngram store a row at a time, so callers can stream rows of any
+    length. Counts wait in a side file until close() appends them. '''
+    def __init__(self, name, n):
+        self.name = name
+        self.n = n
+        self.rows = 0
+        self.f = open(name, 'wb')
+        self.f.write(header.pack(magic, version, n, 0))
+        self.countFile = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(name)))
+        self.ngramStruct = struct.Struct('<%db' % (n,))
+        self.countStruct = struct.Struct('<' + countFormat)
+
+    def add(self, count, ng):
+        if len(ng) != self.n:
+            raise Exception, 'ngram %s is not %d long' % (str(ng), self.n)
+        if count > maxCount:
+            raise Exception, 'count %d too large for %s' % (count, self.name)
+        self.f.write(self.ngramStruct.pack(*ng))
+        self.countFile.write(self.countStruct.pack(count))
+        self.rows += 1
+
+    def close(self):
+        self.countFile.seek(0)
+        shutil.copyfileobj(self.countFile, self.f)
+        self.countFile.close()
+        self.f.seek(0)
+        self.f.write(header.pack(magic, version, self.n, self.rows))
+        self.f.close()
+
+def writeStore(name, n, rows):
+    ''' rows are (count, ngram) pairs already sorted most popular first '''
+    writer = StoreWriter(name, n)
+    for count, ng in rows:
+        writer.add(count, ng)
+    writer.close()
+
+# Stores of ngram files that have no binary store of their own can be shared by
+# the processes on a machine: the first to want one parses the file into a store
+# in a shared directory, such as /dev/shm/genmotifs, and the rest map it. Each
+# store is named for the path of its source and then for its size and
+# modification time, so an edited source gets a new store that replaces only
+# the older stores of that same path.
+
+def sharedStore(directory, source, n, readRows):
+    ''' the name of the shared store of source, an ngram file of n intervals,
+    written from the (count, ngram) rows of readRows() if no process has yet '''
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass        # made by another process just now
+    source = os.path.abspath(source)
+    st = os.stat(source)
+    pathDigest = hashlib.sha1(source).hexdigest()[:16]
+    digest = hashlib.sha1(repr((st.st_size, st.st_mtime))).hexdigest()[:16]
+    name = os.path.join(directory, 'ngram%d-%s-%s.bin' % (n, pathDigest, digest))
+    if os.path.exists(name):
+        return name
+    # one process writes while the others wait for it rather than parse too
+    lock = open(os.path.join(directory, 'ngram%d-%s.lock' % (n, pathDigest)), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(name):
+            for stale in glob.glob(os.path.join(directory, 'ngram%d-%s-*.bin' % (n, pathDigest))):
+                os.remove(stale)        # processes still mapping it keep their pages
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            os.close(fd)
+            writeStore(tmp, n, readRows())
+            os.chmod(tmp, 0644)
+            os.rename(tmp, name)
+    finally:
+        lock.close()
+    return name
+
+class NgramStore(object):
+    ''' Read only, memory mapped view of an ngramN.bin file '''
+    def __init__(self, name):
+        self.name = name
+        f = open(name, 'rb')
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        tag, fileVersion, self.n, self.rows = header.unpack_from(self.mm, 0)
+        if tag != magic or fileVersion != version:
+            raise Exception, '%s is not a version %d ngram store' % (name, version)
+        self.intervalOffset = header.size
+        self.countOffset = self.intervalOffset + self.rows * self.n
+        if len(self.mm) != self.countOffset + self.rows * countSize:
+            raise Exception, '%s is truncated' % (name,)
+        self.ngramStruct = struct.Struct('<%db' % (self.n,))
+        self.countStruct = struct.Struct('<' + countFormat)
+
+    def __len__(self):
+        return self.rows
+
+    def ngram(self, row):
+        return self.ngramStruct.unpack_from(self.mm, self.intervalOffset + row * self.n)
+
+    def count(self, row):
+        return self.countStruct.unpack_from(self.mm, self.countOffset + row * countSize)[0]
+
+    def __iter__(self):
+        ''' yield (ngram, count) pairs, most popular first '''
+        return self.iterRows(0, self.rows)
+
+    def iterRows(self, start, stop, skip=None):
+        ''' yield the (ngram, count) pairs of rows start to stop. skip is for
+        BlockStore, as this store has no blocks to pass over. '''
+        mm = self.mm
+        n = self.n
+        unpackNgram = self.ngramStruct.unpack_from
+        unpackCount = self.countStruct.unpack_from
+        ngOffset = self.intervalOffset + start * n
+        countOffset = self.countOffset + start * countSize
+        for row in xrange(start, stop):
+            yield unpackNgram(mm, ngOffset), unpackCount(mm, countOffset)[0]
+            ngOffset += n
+            countOffset += countSize
+
+    def arrays(self):
+        ''' (intervals, counts) numpy views of the whole store '''
+        intervals = numpy.frombuffer(self.mm, dtype=numpy.int8, count=self.rows * self.n,
+                                     offset=self.intervalOffset).reshape(self.rows, self.n)
+        counts = numpy.frombuffer(self.mm, dtype='<u' + str(countSize), count=self.rows,
+                                  offset=self.countOffset)
+        return intervals, counts
+
+    def blocks(self, blockRows, maxBlockRows, start=0, stop=None, skip=None):
+        ''' yield (intervals, counts) numpy views of consecutive rows from start
+        to stop, starting with blockRows rows and doubling up to maxBlockRows.
+        skip is for BlockStore. '''
+        if stop is None:
+            stop = self.rows
+        if start >= stop:
+            return
+        intervals, counts = self.arrays()
+        intervals = intervals[:stop]
+        counts = counts[:stop]
+        while start < stop:
+            yield intervals[start:start+blockRows], counts[start:start+blockRows]
+            start += blockRows
+            blockRows = min(2 * blockRows, maxBlockRows)
+
+    def close(self):
+        self.mm.close()
+
+# Compressed form, ngramN.blk, for keeping the larger tables small on disk.
+#
+# The rows are cut into blocks of a fixed number of rows, in the same count
+# descending order, and each block is deflated on its own:
+#     header     magic, version, n, number of rows, rows per block, number of
+#                blocks, offset of the directory
+#     blocks     rows * n signed bytes of intervals, then each count as a
+#                zigzag varint of how far it fell from the row before, the first
+#                from the block's largest count
+#     directory  for each block its offset, length, rows, largest and smallest
+#                count and the smallest and largest leap of its ngrams
+# The directory lets a reader pass over a block without inflating it when none
+# of its counts could make a top list or every ngram in it leaps too far.
+
+blockMagic = 'NGRZ'
+blockVersion = 1
+blockHeader = struct.Struct('<4sHHQIIQ')
+blockEntry = struct.Struct('<QIIIIBB')
+defaultBlockRows = 4096
+
+def blockStoreName(directory, n):
+    return os.path.join(directory, 'ngram%d.blk' % (n,))
+
+def openStore(name):
+    ''' NgramStore or BlockStore, as the name's suffix says '''
+    if name.endswith('.blk'):
+        return BlockStore(name)
+    return NgramStore(name)
+
+def appendVarint(out, value):
+    while value >= 0x80:
+        out.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    out.append(chr(value))
+
+class BlockStoreWriter(object):
+    ''' StoreWriter for a BlockStore '''
+    def __init__(self, name, n, blockRows=defaultBlockRows):
+        self.name = name
+        self.n = n
+        self.blockRows = blockRows
+        self.rows = 0
+        self.directory = []
+        self.pending = []
+        self.f = open(name, 'wb')
+        self.f.write(blockHeader.pack(blockMagic, blockVersion, n, 0, blockRows, 0, 0))
+        self.ngramStruct = struct.Struct('<%db' % (n,))
+
+    def add(self, count, ng):
+        if len(ng) != self.n:
+            raise Exception, 'ngram %s is not %d long' % (str(ng), self.n)
+        if count > maxCount:
+            raise Exception, 'count %d too large for %s' % (count, self.name)
+        self.pending.append((count, ng))
+        self.rows += 1
+        if len(self.pending) == self.blockRows:
+            self.flushBlock()
+
+    def flushBlock(self):
+        rows = self.pending
+        self.pending = []
+        if not rows:
+            return
+        counts = [ count for count, ng in rows ]
+        leaps = [ max([ abs(step) for step in ng ] or [0]) for count, ng in rows ]
+        out = [ self.ngramStruct.pack(*ng) for count, ng in rows ]
+        previous = max(counts)
+        for count in counts:
+            fall = previous - count
+            if fall >= 0:
+                appendVarint(out, 2 * fall)
+            else:
+                appendVarint(out, -2 * fall - 1)
+            previous = count
+        data = zlib.compress(''.join(out))
+        self.directory.append((self.f.tell(), len(data), len(rows), max(counts), min(counts),
+                               min(leaps), max(leaps)))
+        self.f.write(data)
+
+    def close(self):
+        self.flushBlock()
+        directoryOffset = self.f.tell()
+        for entry in self.directory:
+            self.f.write(blockEntry.pack(*entry))
+        self.f.seek(0)
+        self.f.write(blockHeader.pack(blockMagic, blockVersion, self.n, self.rows, self.blockRows,
+                                      len(self.directory), directoryOffset))
+        self.f.close()
+
+def compressStore(name, blockName, blockRows=defaultBlockRows):
+    ''' write the rows of the NgramStore name as the BlockStore blockName '''
+    store = NgramStore(name)
+    writer = BlockStoreWriter(blockName, store.n, blockRows)
+    try:
+        for ng, count in store:
+            writer.add(count, ng)
+    finally:
+        store.close()
+    writer.close()
+
+class BlockStore(object):
+    ''' Read only view of an ngramN.blk file, inflating a block at a time. It
+    reads like an NgramStore, and its readers may pass a skip(maxCount, minLeap)
+    that says which blocks they have no use for. '''
+    def __init__(self, name):
+        self.name = name
+        f = open(name, 'rb')
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (tag, fileVersion, self.n, self.rows, self.blockRows, nBlocks,
+         directoryOffset) = blockHeader.unpack_from(self.mm, 0)
+        if tag != blockMagic or fileVersion != blockVersion:
+            raise Exception, '%s is not a version %d block store' % (name, blockVersion)
+        if len(self.mm) != directoryOffset + nBlocks * blockEntry.size:
+            raise Exception, '%s is truncated' % (name,)
+        self.directory = [ blockEntry.unpack_from(self.mm, directoryOffset + k * blockEntry.size)
+                           for k in xrange(nBlocks) ]
+        self.ngramStruct = struct.Struct('<%db' % (self.n,))
+
+    def __len__(self):
+        return self.rows
+
+    def decode(self, k):
+        ''' the (intervals, counts) of block k, numpy arrays as NgramStore.arrays
+        gives them, or lists of ngram tuples and counts without numpy '''
+        offset, length, rows, blockMax, blockMin, minLeap, maxLeap = self.directory[k]
+        data = zlib.decompress(self.mm[offset:offset+length])
+        nIntervals = rows * self.n
+        if numpy is None:
+            ngrams = [ self.ngramStruct.unpack_from(data, row * self.n) for row in xrange(rows) ]
+            counts = []
+            count = blockMax
+            value = shift = 0
+            for byte in data[nIntervals:]:
+                byte = ord(byte)
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    count -= (value >> 1) ^ -(value & 1)
+                    counts.append(count)
+                    value = shift = 0
+            return ngrams, counts
+        intervals = numpy.frombuffer(data, dtype=numpy.int8, count=nIntervals).reshape(rows, self.n)
+        varints = numpy.frombuffer(data, dtype=numpy.uint8, offset=nIntervals)
+        ends = varints < 0x80
+        firsts = numpy.flatnonzero(numpy.concatenate(([True], ends[:-1])))
+        group = numpy.cumsum(ends) - ends
+        shifts = 7 * (numpy.arange(len(varints)) - firsts[group])
+        values = numpy.add.reduceat((varints & 0x7f).astype(numpy.int64) << shifts, firsts)
+        falls = (values >> 1) ^ -(values & 1)
+        counts = (blockMax - numpy.cumsum(falls)).astype('<u' + str(countSize))
+        return intervals, counts
+
+    def spans(self, start, stop, skip):
+        ''' yield (k, first, last) for the blocks holding rows start to stop
+        that skip keeps, with the rows of the block wanted '''
+        stop = min(stop, self.rows)
+        if start >= stop:
+            return
+        for k in xrange(start // self.blockRows, -(-stop // self.blockRows)):
+            offset, length, rows, blockMax, blockMin, minLeap, maxLeap = self.directory[k]
+            if skip and skip(blockMax, minLeap):
+                continue
+            blockStart = k * self.blockRows
+            yield k, max(start - blockStart, 0), min(stop - blockStart, rows)
+
+    def __iter__(self):
+        return self.iterRows(0, self.rows)
+
+    def iterRows(self, start, stop, skip=None):
+        for k, first, last in self.spans(start, stop, skip):
+            intervals, counts = self.decode(k)
+            if numpy is not None:
+                intervals = [ tuple(ng) for ng in intervals[first:last].tolist() ]
+                counts = counts[first:last].tolist()
+            else:
+                intervals = intervals[first:last]
+                counts = counts[first:last]
+            for row in zip(intervals, counts):
+                yield row
+
+    def arrays(self):
+        ''' (intervals, counts) numpy arrays of the whole store, inflated '''
+        if self.rows == 0:
+            return (numpy.zeros((0, self.n), dtype=numpy.int8),
+                    numpy.zeros(0, dtype='<u' + str(countSize)))
+        blocks = [ self.decode(k) for k in xrange(len(self.directory)) ]
+        return (numpy.concatenate([ intervals for intervals, counts in blocks ]),
+                numpy.concatenate([ counts for intervals, counts in blocks ]))
+
+    def blocks(self, blockRows, maxBlockRows, start=0, stop=None, skip=None):
+        ''' NgramStore.blocks, cutting the blocks skip keeps into the same
+        doubling pieces '''
+        if stop is None:
+            stop = self.rows
+        for k, first, last in self.spans(start, stop, skip):
+            intervals, counts = self.decode(k)
+            while first < last:
+                end = min(first + blockRows, last)
+                yield intervals[first:end], counts[first:end]
+                first = end
+                blockRows = min(2 * blockRows, maxBlockRows)
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,102 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Sorted prefix index over the ngrams of several sizes at once. A walk from a
+# start pitch visits each distinct prefix once for every size sharing it, and
+# drops a prefix, along with everything extending it, as soon as it breaks the
+# chromatic, conjunct or unison limit.
+#
+# The ngrams are padded to the longest size and sorted together. Level d has
+# one node per distinct prefix of d+1 intervals, holding its last step, the
+# start of its children's range at level d+1, and the file row of the ngram of
+# d+1 intervals that is exactly that prefix (-1 if there is none).
+
+pad = -128      # sorts before every real interval
+
+class NgramTrie(object):
+    def __init__(self, intervalsBySize):
+        ''' intervalsBySize maps n to the 2-D array of n interval rows, in file order '''
+        sizes = sorted(intervalsBySize)
+        maxN = sizes[-1]
+        nRows = sum([len(intervalsBySize[n]) for n in sizes])
+        padded = numpy.empty((nRows, maxN), dtype=numpy.int8)
+        padded.fill(pad)
+        rowSizes = numpy.empty(nRows, dtype=numpy.int8)
+        rows = numpy.empty(nRows, dtype=numpy.int32)
+        offset = 0
+        for n in sizes:
+            block = intervalsBySize[n]
+            padded[offset:offset+len(block), :n] = block
+            rowSizes[offset:offset+len(block)] = n
+            rows[offset:offset+len(block)] = numpy.arange(len(block))
+            offset += len(block)
+        order = numpy.lexsort(padded.T[::-1])
+        padded = padded[order]
+        rowSizes = rowSizes[order]
+        rows = rows[order]
+
+        self.steps = []
+        self.childStarts = []
+        self.ends = []
+        newGroup = numpy.zeros(nRows, dtype=bool)
+        previousNodeOf = None
+        for d in xrange(maxN):
+            column = padded[:, d]
+            newGroup[1:] |= column[1:] != column[:-1]
+            newGroup[:1] = True
+            starts = newGroup & (rowSizes > d)
+            nodeOf = numpy.cumsum(starts) - 1   # node of each row that reaches level d
+            starts = numpy.flatnonzero(starts)
+            self.steps.append(column[starts])
+            if d:
+                parents = previousNodeOf[starts]
+                nParents = len(self.steps[d-1])
+                self.childStarts.append(numpy.searchsorted(parents, numpy.arange(nParents + 1)))
+            ends = numpy.empty(len(starts), dtype=numpy.int32)
+            ends.fill(-1)
+            endRows = numpy.flatnonzero(rowSizes == d+1)
+            ends[nodeOf[endRows]] = rows[endRows]
+            self.ends.append(ends)
+            previousNodeOf = nodeOf
+
+    def walk(self, startPitch, inScaleTable, nChromatics, conjunct, unisons, minGrams, maxGrams):
+        ''' returns the file rows, by size, of the ngrams that keep within the
+        limits from startPitch and have exactly nChromatics outside the scale '''
+        found = {}
+        nodes = numpy.arange(len(self.steps[0]))
+        pitches = numpy.empty(len(nodes), dtype=numpy.int32)
+        pitches.fill(startPitch)
+        chromatics = numpy.zeros(len(nodes), dtype=numpy.int32)
+        zeroSteps = numpy.zeros(len(nodes), dtype=numpy.int32)
+        for d in xrange(min(maxGrams, len(self.steps))):
+            if d:
+                # expand the surviving nodes into their children
+                lo = self.childStarts[d-1][nodes]
+                nChildren = self.childStarts[d-1][nodes + 1] - lo
+                parents = numpy.repeat(numpy.arange(len(nodes)), nChildren)
+                firstChild = numpy.cumsum(nChildren) - nChildren
+                nodes = numpy.arange(nChildren.sum()) - firstChild[parents] + lo[parents]
+                pitches = pitches[parents]
+                chromatics = chromatics[parents]
+                zeroSteps = zeroSteps[parents]
+            steps = self.steps[d][nodes].astype(numpy.int32)
+            pitches = pitches + steps
+            chromatics = chromatics + ~inScaleTable[pitches % 12]
+            zeroSteps = zeroSteps + (steps == 0)
+            alive = chromatics <= nChromatics
+            if conjunct != None:
+                alive &= numpy.abs(steps) <= conjunct
+            if unisons != None:
+                alive &= zeroSteps <= unisons
+            nodes = nodes[alive]
+            pitches = pitches[alive]
+            chromatics = chromatics[alive]
+            zeroSteps = zeroSteps[alive]
+            if d + 1 >= minGrams:
+                ends = self.ends[d][nodes]
+                found[d+1] = numpy.sort(ends[(ends >= 0) & (chromatics == nChromatics)])
+            if not len(nodes):
+                break
+        return found
@@ -0,0 +1,58 @@
+# Pitch class sets as 12 bit integers, with bit pc set for each pitch class pc.
+# Subset, intersection and size tests are single integer operations, and
+# transposition is a rotation of the 12 bits.
+
+allPcs = (1 << 12) - 1
+pcBits = [1 << pc for pc in xrange(12)]
+pcCounts = [bin(mask).count('1') for mask in xrange(1 << 12)]
+
+def rotate(mask, n):
+    ''' transpose the pitch classes in mask up n semitones '''
+    n %= 12
+    return ((mask << n) | (mask >> (12 - n))) & allPcs
+
+def pcMask(pcs):
+    ''' mask of pitch classes already reduced mod 12 '''
+    mask = 0
+    for pc in pcs:
+        mask |= pcBits[pc]
+    return mask
+
+class PcSet(int):
+    ''' A pitch class set that is also its 12 bit mask. Bitwise operators give
+    back plain ints, which is all the filters need in their inner loops. '''
+    def __new__(cls, pcs=()):
+        mask = 0
+        for pc in pcs:
+            if not 0 <= pc < 12:
+                raise ValueError, '%s is not a pitch class' % (pc,)
+            mask |= pcBits[pc]
+        return int.__new__(cls, mask)
+
+    @classmethod
+    def fromMask(cls, mask):
+        return int.__new__(cls, mask & allPcs)
+
+    def __contains__(self, pc):
+        return 0 <= pc < 12 and self & pcBits[pc] != 0
+
+    def __iter__(self):
+        return (pc for pc in xrange(12) if self & pcBits[pc])
+
+    def __len__(self):
+        return pcCounts[self]
+
+    def issubset(self, other):
+        return self & other == self
+
+    def intersects(self, other):
+        return self & other != 0
+
+    def transpose(self, n):
+        return PcSet.fromMask(rotate(self, n))
+
+    def __reduce__(self):
+        return (PcSet, (list(self),))
+
+    def __repr__(self):
+        return 'PcSet(%s)' % (list(self),)
@@ -1,28 +1,370 @@
 #!/usr/bin/env python
 
-import sys, pdb
+import sys, os, pdb, heapq, marshal, shutil, tempfile, multiprocessing, threading
+import gzip, bz2, zipfile
+import ngramstore
+
+# I use reformatted datasets from:
+#    http://www.peachnote.com/datasets.html
+#    created by Vladimir Viro
+# Purpose of reformatting is to order by popularity
+
+def inputName(i):
+    return 'imslp-interval-%dgram-20110401.csv' % (i,)
+
+# The datasets ship compressed, and can be read without unzipping them first
+compressedSuffixes = ['.gz', '.bz2', '.zip']
+blockSize = 1 << 20
+
+def findInput(i):
+    ''' the plain or compressed interval file for n, or None if there is neither '''
+    name = inputName(i)
+    candidates = [name] + [ name + suffix for suffix in compressedSuffixes ]
+    candidates.append(os.path.splitext(name)[0] + '.zip')
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def inputPath(i):
+    name = findInput(i)
+    if name is None:
+        raise IOError, 'no %s or compressed copy of it' % (inputName(i),)
+    return name
+
+def isCompressed(name):
+    return os.path.splitext(name)[1] in compressedSuffixes
+
+def openCompressed(name):
+    suffix = os.path.splitext(name)[1]
+    if suffix == '.gz':
+        return gzip.open(name, 'rb')
+    if suffix == '.bz2':
+        return bz2.BZ2File(name, 'rb')
+    archive = zipfile.ZipFile(name)
+    members = archive.namelist()
+    if len(members) != 1:
+        raise Exception, '%s should hold exactly one file' % (name,)
+    return archive.open(members[0])
+
+class DecompressedInput(object):
+    ''' Reads a compressed file through a pipe fed by a decompressing thread.
+    zlib and bz2 release the GIL, so decompression overlaps with parsing, and
+    lines come from the pipe's C readline rather than gzip's Python one. '''
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        r, w = os.pipe()
+        self.f = os.fdopen(r, 'rb')
+        self.worker = threading.Thread(target=self.decompress, args=(w,))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def decompress(self, fd):
+        pipe = os.fdopen(fd, 'wb')
+        try:
+            src = openCompressed(self.name)
+            try:
+                block = src.read(blockSize)
+                while block:
+                    pipe.write(block)
+                    block = src.read(blockSize)
+            finally:
+                src.close()
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            try:
+                pipe.close()
+            except IOError:
+                pass            # reader went away early
+
+    def readline(self):
+        line = self.f.readline()
+        if not line:
+            self.worker.join()
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+        return line
+
+    def close(self):
+        self.f.close()
+        self.worker.join()
+
+def openInput(name):
+    if isCompressed(name):
+        return DecompressedInput(name)
+    return open(name, 'rb')
+
+def readIntervals(name, start=0, stop=None):
+    ''' yield (ngram, count) for each line of a Peachnote interval file, or for
+    the lines of one byte range of it from lineRanges '''
+    if start:
+        f = open(name, 'rb')
+        f.seek(start)
+    else:
+        f = openInput(name)
+    try:
+        position = start
+        while stop is None or position < stop:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            line = line.rstrip()
+            ng, year, count = line.split('\t')
+            count = int(count)
+            ng = ng.split()
+            ng = map(int, ng)
+            yield tuple(ng), count
+    finally:
+        f.close()
+
+def writeNgrams(i, rows):
+    ''' write (count, ngram) rows, most popular first, as ngramN.csv and ngramN.bin '''
+    # both are written aside and renamed once complete, so a run that fails
+    # part way leaves the old files, if any, rather than half written ones
+    names = ['ngram%d.csv' % (i,), ngramstore.storeName('.', i)]
+    tmps = [ name + '.tmp' for name in names ]
+    try:
+        f = open(tmps[0], 'w')
+        # same rows again as a memory mappable binary store for genmotifs
+        store = ngramstore.StoreWriter(tmps[1], i)
+        for count, ng in rows:
+            for jump in ng:
+                f.write('%d ' % (jump,))
+            f.write('\t2012\t%d\n' % (count,))
+            store.add(count, ng)
+        f.close()
+        store.close()
+    except:
+        for tmp in tmps:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+    for tmp, name in zip(tmps, names):
+        os.rename(tmp, name)
+
+def reformat(i):
+    db = {}
+    for ng, count in readIntervals(inputPath(i)):
+        if ng in db:
+            db[ ng ] += count
+        else:
+            db[ ng ] = count
+
+    array = [ (count, ng) for ng, count in db.iteritems() ]
+    db = None
+    array.sort(reverse=True)
+    writeNgrams(i, array)
+
+# Streaming mode for files whose counts do not fit in memory. Counts are summed
+# a budget's worth at a time and spilled as runs sorted by ngram, the runs are
+# merged to finish the sums, and the totals are externally sorted by count.
+# Runs are merged at most maxFanIn at a time, in passes, so the files open at
+# once stay bounded however large the input is.
+
+maxFanIn = 64
+
+def entriesInBudget(n, memoryBudget):
+    # rough size of a dict entry keyed by a tuple of n small ints
+    return max(1, memoryBudget / (120 + 8 * n))
+
+def writeRun(rows, tmpdir):
+    fd, name = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    f = os.fdopen(fd, 'wb')
+    for row in rows:
+        marshal.dump(row, f)
+    f.close()
+    return name
+
+def readRun(name):
+    ''' runs are read exactly once, so the file is removed as soon as it is done '''
+    f = open(name, 'rb')
+    try:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                break
+    finally:
+        f.close()
+        os.remove(name)
+
+def mergeRuns(runs):
+    ''' a sorted merge of all the rows of runs, opening at most maxFanIn of
+    them at a time '''
+    while len(runs) > maxFanIn:
+        tmpdir = os.path.dirname(runs[0])
+        runs = [ writeRun(heapq.merge(*[readRun(run) for run in runs[k:k+maxFanIn]]), tmpdir)
+                 for k in xrange(0, len(runs), maxFanIn) ]
+    return heapq.merge(*[readRun(run) for run in runs])
+
+def spillCounts(pairs, maxEntries, tmpdir):
+    runs = []
+    db = {}
+    for ng, count in pairs:
+        if ng in db:
+            db[ ng ] += count
+        else:
+            if len(db) >= maxEntries:
+                runs.append(writeRun(sorted(db.iteritems()), tmpdir))
+                db = {}
+            db[ ng ] = count
+    if db:
+        runs.append(writeRun(sorted(db.iteritems()), tmpdir))
+    return runs
+
+def mergeCounts(runs):
+    ''' k-way merge of runs sorted by ngram, summing the counts of equal ngrams '''
+    current = None
+    total = 0
+    for ng, count in mergeRuns(runs):
+        if ng == current:
+            total += count
+        else:
+            if current is not None:
+                yield current, total
+            current = ng
+            total = count
+    if current is not None:
+        yield current, total
+
+def sortByCount(pairs, maxEntries, tmpdir):
+    ''' yield (count, ngram) most popular first, in the same order as
+    sort(reverse=True) gives in memory '''
+    # all ngrams have the same length, so negating every field makes an
+    # ascending merge come out in exactly the reverse order
+    runs = []
+    chunk = []
+    for ng, count in pairs:
+        chunk.append((-count, tuple([-x for x in ng])))
+        if len(chunk) >= maxEntries:
+            chunk.sort()
+            runs.append(writeRun(chunk, tmpdir))
+            chunk = []
+    if chunk:
+        chunk.sort()
+        runs.append(writeRun(chunk, tmpdir))
+        chunk = None
+    for count, ng in mergeRuns(runs):
+        yield -count, tuple([-x for x in ng])
+
+def reformatExternal(i, memoryBudget, tmpdir):
+    maxEntries = entriesInBudget(i, memoryBudget)
+    workdir = tempfile.mkdtemp(prefix='ngram%d.' % (i,), dir=tmpdir)
+    try:
+        runs = spillCounts(readIntervals(inputPath(i)), maxEntries, workdir)
+        writeNgrams(i, sortByCount(mergeCounts(runs), maxEntries, workdir))
+    finally:
+        shutil.rmtree(workdir)
+
+# Parallel mode. Whole files are reformatted concurrently, and files too big for
+# one worker are cut into line aligned byte ranges whose partial count tables
+# come back as runs for mergeCounts.
+
+def lineRanges(name, pieces):
+    ''' split a file into byte ranges that each start just after a newline '''
+    size = os.path.getsize(name)
+    offsets = [0]
+    f = open(name, 'rb')
+    for k in xrange(1, pieces):
+        f.seek(size * k / pieces)
+        f.readline()
+        offset = f.tell()
+        if offsets[-1] < offset < size:
+            offsets.append(offset)
+    f.close()
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+def countRange(i, start, stop, maxEntries, tmpdir):
+    return spillCounts(readIntervals(inputPath(i), start, stop), maxEntries, tmpdir)
+
+def finishCounts(i, runs, memoryBudget, tmpdir):
+    pairs = mergeCounts(runs)
+    if memoryBudget:
+        writeNgrams(i, sortByCount(pairs, entriesInBudget(i, memoryBudget), tmpdir))
+    else:
+        array = [ (count, ng) for ng, count in pairs ]
+        array.sort(reverse=True)
+        writeNgrams(i, array)
+
+def reformatFile(i, memoryBudget, tmpdir):
+    if memoryBudget:
+        reformatExternal(i, memoryBudget, tmpdir)
+    else:
+        reformat(i)
+
+def reformatParallel(ns, jobs, splitSize, memoryBudget, tmpdir):
+    pool = multiprocessing.Pool(jobs)
+    whole = []
+    split = []
+    for i in ns:
+        name = inputPath(i)
+        print name
+        # compressed files can only be read from the start
+        if splitSize and not isCompressed(name) and os.path.getsize(name) > splitSize:
+            if memoryBudget:
+                maxEntries = entriesInBudget(i, memoryBudget)
+            else:
+                maxEntries = sys.maxint
+            workdir = tempfile.mkdtemp(prefix='ngram%d.' % (i,), dir=tmpdir)
+            pieces = [ pool.apply_async(countRange, (i, start, stop, maxEntries, workdir))
+                       for start, stop in lineRanges(name, jobs) ]
+            split.append((i, workdir, pieces))
+        else:
+            whole.append(pool.apply_async(reformatFile, (i, memoryBudget, tmpdir)))
+    try:
+        finishing = []
+        for i, workdir, pieces in split:
+            runs = []
+            for piece in pieces:
+                runs.extend(piece.get())
+            finishing.append(pool.apply_async(finishCounts, (i, runs, memoryBudget, workdir)))
+        for result in finishing + whole:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+        for i, workdir, pieces in split:
+            shutil.rmtree(workdir)
 
 if __name__ == '__main__':
-    options = ['help']
+    options = ['help', 'memory=', 'tmpdir=', 'jobs=', 'split=', 'compress']
 
     def usage():
         print 'ngrams.py n1 [n2]'
         print 'Options:'
         for word in options:
             print '  ', word
+        print '  --memory=MB sorts on disk, holding about MB megabytes of counts at a time'
+        print '  --jobs=N reformats files in N processes'
+        print '  --split=MB also divides input files larger than MB megabytes among the N processes'
+        print '  --compress replaces each ngramN.bin with ngramN.blk, a deflated block store'
         sys.exit(0)
-        
+
     import getopt
     def main():
-        # I use reformatted datasets from:
-        #    http://www.peachnote.com/datasets.html
-        #    created by Vladimir Viro
-        # Purpose of reformatting is to order by popularity
-
+        memoryBudget = None
+        tmpdir = '.'
+        jobs = 1
+        splitSize = None
+        compress = False
         opts, pargs = getopt.getopt(sys.argv[1:], '', options)
         for opt, val in opts:
             if opt == '--help':
                 usage()
+            elif opt == '--memory':
+                memoryBudget = int(float(val) * 1024 * 1024)
+            elif opt == '--tmpdir':
+                tmpdir = val
+            elif opt == '--jobs':
+                jobs = int(val)
+            elif opt == '--split':
+                splitSize = int(float(val) * 1024 * 1024)
+            elif opt == '--compress':
+                compress = True
 
         if len(pargs) < 2:
             usage()
@@ -31,40 +373,23 @@ if __name__ == '__main__':
             n2 = int(pargs[1])
 
 
+        ns = []
         for i in xrange(n1, n2+1):
-            db = {}
-            # I let Vladimir know I can't unzip the 14ngram file (has been no problem for my use)
-            if i == 14:
+            # I let Vladimir know I can't unzip the 14ngram file, so it may well be missing
+            if i == 14 and findInput(i) is None:
+                print 'skipping', inputName(i)
                 continue
-            name = 'imslp-interval-%dgram-20110401.csv' % (i,)
-            print name
-            f = open(name)
-            line = f.readline()
-            while line:
-                line = line.rstrip()
-                ng, year, count = line.split('\t')
-                count = int(count)
-                ng = ng.split()
-                ng = map(int, ng)
-                ng = tuple(ng)
-                if ng in db:
-                    db[ ng ] += count
-                else:
-                    db[ ng ] = count
-                line = f.readline()
-            f.close()
-
-            array = [ (count, ng) for ng, count in db.iteritems() ]
-            db = None
-            array.sort(reverse=True)
-
-            name = 'ngram%d.csv' % (i,)
-            f = open(name, 'w')
-            for count, ng in array:
-                for jump in ng:
-                    f.write('%d ' % (jump,))
-                f.write('\t2012\t%d\n' % (count,))
-            f.close()
-            array = None
+            ns.append(i)
+        if jobs > 1:
+            reformatParallel(ns, jobs, splitSize, memoryBudget, tmpdir)
+        else:
+            for i in ns:
+                print inputPath(i)
+                reformatFile(i, memoryBudget, tmpdir)
+        if compress:
+            for i in ns:
+                name = ngramstore.storeName('.', i)
+                ngramstore.compressStore(name, ngramstore.blockStoreName('.', i))
+                os.remove(name)
 
 main()
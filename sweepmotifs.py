@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import sys, csv, json, getopt
+import genmotifs
+numpy = genmotifs.numpy
+
+# What genmotifs would find over a grid of --conjunct, --unisons, --minPcs,
+# --chromatics and --top values, from one scan of the ngram files.
+#
+# The largest leap, the unison count and the number of pitch classes of an
+# ngram are the same from every start pitch, so each block of ngrams is placed
+# once per scale in the tightest (conjunct, unisons, minPcs) cell admitting it:
+# the smallest conjunct and unisons at least as large as its own, and the
+# largest minPcs no more than its own. A cell's candidates are then the sum
+# over the cells inside it. The ngram files are sorted by count, so only the
+# first rows of each file in each cell, up to the largest --top, can make a
+# top list.
+
+axes = ['conjunct', 'unisons', 'minPcs', 'chromatics', 'top']
+columns = ['scale', 'start'] + axes + ['candidates', 'mass', 'kept', 'keptMass', 'lowestKept']
+
+def parseGrid(val):
+    ''' conjunct:3,5,7;top:50,100 as a dict of sorted value lists '''
+    grid = {}
+    for part in val.split(';'):
+        if not part:
+            continue
+        name, values = part.split(':')
+        if name not in axes:
+            raise Exception, 'no sweep axis %s' % (name,)
+        grid[name] = sorted(set(map(int, values.split(','))))
+    return grid
+
+class StartSweep(object):
+    ''' the candidates from one start pitch of a scale, by grid point '''
+    def __init__(self, scale, startPitch, queryArgs, grid, nPoints):
+        self.startPitch = startPitch
+        self.nPoints = nPoints
+        self.maxTop = max(grid['top'])
+        # the other filters stay as the settings have them
+        self.queries = []
+        for nChromatics in grid['chromatics']:
+            args = dict(queryArgs)
+            args.update(conjunct=None, unisons=None, minPcs=0, nChromatics=nChromatics)
+            self.queries.append(genmotifs.MotifQuery(scale, startPitch=startPitch, **args))
+        self.candidates = numpy.zeros((len(self.queries), nPoints), dtype=numpy.int64)
+        self.mass = numpy.zeros((len(self.queries), nPoints), dtype=numpy.int64)
+        # the counts of the rows that could make a top list, by point
+        self.tops = [ [ [] for p in xrange(nPoints) ] for query in self.queries ]
+        self.taken = None
+
+    def startFile(self):
+        self.taken = numpy.zeros((len(self.queries), self.nPoints), dtype=numpy.int64)
+
+    def add(self, profile, counts, points):
+        for k, query in enumerate(self.queries):
+            keep, pitches = query.filterBlock(profile)
+            rows = numpy.flatnonzero(keep & (points >= 0))
+            p = points[rows]
+            c = counts[rows]
+            self.candidates[k] += numpy.bincount(p, minlength=self.nPoints)
+            numpy.add.at(self.mass[k], p, c)
+
+            # the first maxTop rows of this file at each point
+            order = numpy.argsort(p, kind='mergesort')
+            sortedPoints = p[order]
+            rank = (numpy.arange(len(order)) - numpy.searchsorted(sortedPoints, sortedPoints)
+                    + self.taken[k][sortedPoints])
+            take = order[rank < self.maxTop]
+            self.taken[k] += numpy.bincount(p, minlength=self.nPoints)
+            tops = self.tops[k]
+            for point, count in zip(p[take].tolist(), c[take].tolist()):
+                tops[point].append(count)
+
+class ScaleSweep(object):
+    def __init__(self, scaleClassname, settings, grid):
+        self.scaleClassname = scaleClassname
+        scale = getattr(genmotifs, scaleClassname)()
+        startPitches, queryArgs = genmotifs.scaleQueryArgs(settings, scale)
+        self.minGrams = queryArgs['minGrams']
+        self.maxGrams = queryArgs['maxGrams']
+        # the axes not swept keep the scale's own setting
+        self.grid = dict(conjunct=[settings.conjunct], unisons=[settings.unisons],
+                         minPcs=[queryArgs['minPcs']], chromatics=[queryArgs['nChromatics']],
+                         top=[queryArgs['nTop']])
+        self.grid.update(grid)
+        # 0 stands for the scale's own value, as it does in genmotifs options,
+        # so the rows name values that reproduce them
+        for axis, default in [('minPcs', scale.minPcs), ('chromatics', scale.nChromatics), ('top', scale.top)]:
+            self.grid[axis] = sorted(set([ value or default for value in self.grid[axis] ]))
+        self.shape = (len(self.grid['conjunct']), len(self.grid['unisons']), len(self.grid['minPcs']))
+        nPoints = self.shape[0] * self.shape[1] * self.shape[2]
+        self.starts = [ StartSweep(scale, startPitch, queryArgs, self.grid, nPoints)
+                        for startPitch in startPitches ]
+
+    def wants(self, i):
+        return self.minGrams <= i <= self.maxGrams
+
+    def points(self, profile):
+        ''' the grid point of each ngram in the block, -1 if no cell admits it '''
+        nConjunct, nUnisons, nMinPcs = self.shape
+        conjunct = numpy.searchsorted(self.grid['conjunct'], profile.maxLeaps)
+        unisons = numpy.searchsorted(self.grid['unisons'], profile.zeroSteps)
+        minPcs = numpy.searchsorted(self.grid['minPcs'], genmotifs.pcCountTable[profile.masks], 'right') - 1
+        points = (conjunct * nUnisons + unisons) * nMinPcs + minPcs
+        points[(conjunct >= nConjunct) | (unisons >= nUnisons) | (minPcs < 0)] = -1
+        return points
+
+    def rows(self):
+        ''' a dict for each cell and top, from each start pitch and then the
+        whole scale, with start '*' '''
+        starts = [ (start.startPitch, start.candidates, start.mass, start.tops) for start in self.starts ]
+        starts.append(('*', sum([start.candidates for start in self.starts]),
+                        sum([start.mass for start in self.starts]),
+                        [ [ sum([start.tops[k][point] for start in self.starts], [])
+                            for point in xrange(len(self.starts[0].tops[k])) ]
+                          for k in xrange(len(self.grid['chromatics'])) ]))
+        grid = self.grid
+        shape = self.shape
+        rows = []
+        for startPitch, candidates, mass, tops in starts:
+            for k, nChromatics in enumerate(grid['chromatics']):
+                cellCandidates = admitted(candidates[k].reshape(shape))
+                cellMass = admitted(mass[k].reshape(shape))
+                for c, conjunct in enumerate(grid['conjunct']):
+                    for u, unisons in enumerate(grid['unisons']):
+                        for m, minPcs in enumerate(grid['minPcs']):
+                            counts = []
+                            for pc in xrange(c + 1):
+                                for pu in xrange(u + 1):
+                                    for pm in xrange(m, shape[2]):
+                                        counts.extend(tops[k][(pc * shape[1] + pu) * shape[2] + pm])
+                            counts.sort(reverse=True)
+                            for top in grid['top']:
+                                kept = counts[:top]
+                                rows.append(dict(scale=self.scaleClassname, start=startPitch,
+                                                 conjunct=conjunct, unisons=unisons, minPcs=minPcs,
+                                                 chromatics=nChromatics, top=top,
+                                                 candidates=int(cellCandidates[c, u, m]),
+                                                 mass=int(cellMass[c, u, m]),
+                                                 kept=len(kept), keptMass=sum(kept),
+                                                 lowestKept=kept and kept[-1] or None))
+        return rows
+
+def admitted(byPoint):
+    ''' sums over the points each (conjunct, unisons, minPcs) cell admits '''
+    cells = byPoint.cumsum(axis=0).cumsum(axis=1)
+    return cells[:, :, ::-1].cumsum(axis=2)[:, :, ::-1]
+
+def sweep(settings, grid):
+    ''' the rows of the sweep of the settings' scales over the grid '''
+    if numpy is None:
+        raise Exception, 'sweeps need numpy'
+    genmotifs.Petrucci = settings.petrucci
+    genmotifs.sharedNgrams = settings.sharedNgrams
+    sweeps = [ ScaleSweep(scaleClassname, settings, grid)
+               for scaleClassname in settings.scaleClassnames if scaleClassname != 'Dyad' ]
+    sizes = set()
+    for scaleSweep in sweeps:
+        sizes.update(xrange(scaleSweep.minGrams, scaleSweep.maxGrams+1))
+    for i in sorted(sizes):
+        if i == 14 and not genmotifs.haveNgrams(i):
+            continue
+        wanting = [ scaleSweep for scaleSweep in sweeps if scaleSweep.wants(i) ]
+        for scaleSweep in wanting:
+            for start in scaleSweep.starts:
+                start.startFile()
+        for intervals, counts in genmotifs.readNgramBlocks(i):
+            profile = genmotifs.BlockProfile(intervals)
+            for scaleSweep in wanting:
+                points = scaleSweep.points(profile)
+                for start in scaleSweep.starts:
+                    start.add(profile, counts, points)
+    rows = []
+    for scaleSweep in sweeps:
+        rows.extend(scaleSweep.rows())
+    return rows
+
+def writeRows(rows, name):
+    ''' JSON if name ends in .json, otherwise CSV '''
+    f = open(name, 'wb')
+    try:
+        if name.endswith('.json'):
+            json.dump(rows, f, indent=1, sort_keys=True)
+        else:
+            writer = csv.DictWriter(f, columns)
+            writer.writerow(dict(zip(columns, columns)))
+            writer.writerows(rows)
+    finally:
+        f.close()
+
+if __name__ == '__main__':
+    options = ['help', 'grid=', 'out=']
+
+    def usage():
+        print 'sweepmotifs.py [--grid=GRID] [--out=FILE] -- [genmotifs options]'
+        print '    GRID is axis:values;... over the axes %s,' % (' '.join(axes),)
+        print '    for example conjunct:3,5,7,11;unisons:0,1;top:100,400'
+        print '    FILE is written as JSON if it ends in .json, otherwise CSV (default sweep.csv)'
+        sys.exit(0)
+
+    def main():
+        grid = {}
+        out = 'sweep.csv'
+        opts, pargs = getopt.getopt(sys.argv[1:], '', options)
+        for opt, val in opts:
+            if opt == '--help':
+                usage()
+            elif opt == '--grid':
+                grid = parseGrid(val)
+            elif opt == '--out':
+                out = val
+        settings = genmotifs.parseOptions(pargs)
+        writeRows(sweep(settings, grid), out)
+
+    main()